@@ -19,7 +19,8 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import exceptions, sys, string, os, gzip, types
+import exceptions, sys, string, os, gzip, types, struct, multiprocessing, time
+import cStringIO
 
 class UEFfile_error(exceptions.Exception):
 
@@ -36,6 +37,110 @@ else:
 
 version = '0.30'
 date = '2019-04-07'
+
+# Precompiled structures for block headers (load address, execution
+# address, block number, block length, block flag, next address) and CRCs.
+block_header = struct.Struct("<IIHHBI")
+block_crc = struct.Struct("<H")
+
+def make_crc_table():
+    """Return a table of the CRC values for each possible byte, for use by the
+    CRC calculation in the UEFfile class."""
+
+    table = []
+
+    for i in range(256):
+
+        value = i << 8
+        for j in range(8):
+            if value & 0x8000:
+                value = ((value << 1) ^ 0x1021) & 0xffff
+            else:
+                value = (value << 1) & 0xffff
+
+        table.append(value)
+
+    return table
+
+crc_table = make_crc_table()
+
+class TimingProfile:
+    """instance = TimingProfile(name, first_tone, block_tone, gap, gap_tone,
+                                dummy_byte = True)
+
+    Describe the lengths of the tones and gaps written around the blocks of
+    files when they are encoded as chunks. The first_tone and block_tone
+    values are the numbers of cycles of high tone written before the first
+    block of a file and before each of its other blocks. The gap and gap_tone
+    values are the lengths of the gap and tone written before each file when
+    gaps are enabled, followed by a dummy byte if dummy_byte is True.
+    """
+
+    def __init__(self, name, first_tone, block_tone, gap, gap_tone,
+                 dummy_byte = True):
+
+        self.name = name
+        self.first_tone = first_tone
+        self.block_tone = block_tone
+        self.gap = gap
+        self.gap_tone = gap_tone
+        self.dummy_byte = dummy_byte
+
+    def gap_chunks(self):
+        """Return the chunks written before a file when gaps are enabled."""
+
+        chunks = [(0x112, struct.pack("<H", self.gap)),
+                  (0x110, struct.pack("<H", self.gap_tone))]
+
+        if self.dummy_byte:
+            chunks.append((0x100, "\xdc"))
+
+        return chunks
+
+    def tone_chunks(self):
+        """Return the tone chunks written before the first block of a file and
+        before each of the other blocks."""
+
+        return ((0x110, struct.pack("<H", self.first_tone)),
+                (0x110, struct.pack("<H", self.block_tone)))
+
+# Standard Acorn timing, as produced when saving files to tape.
+standard_timing = TimingProfile("standard", 0x05dc, 0x0258, 0x05dc, 0x05dc)
+
+# Minimal tones and gaps for use with emulators. There is still enough tone
+# before each block for the MOS to synchronise with it, but the tapes may not
+# load on real hardware.
+turbo_timing = TimingProfile("turbo", 0x00c0, 0x0030, 0x0010, 0x00c0, False)
+
+timing_profiles = {"standard": standard_timing, "turbo": turbo_timing}
+
+def get_timing_profile(spec):
+    """Return the timing profile with the name given, or a custom profile if
+    the specification contains four comma-separated hexadecimal values for
+    the first block tone, other block tone, gap and gap tone lengths."""
+
+    if timing_profiles.has_key(spec):
+        return timing_profiles[spec]
+
+    try:
+        values = map(lambda value: int(value, 16), string.split(spec, ","))
+    except ValueError:
+        values = []
+
+    if len(values) != 4 or not all(map(lambda x: 0 <= x <= 0xffff, values)):
+        raise UEFfile_error, "Invalid timing profile: %s" % spec
+
+    return TimingProfile("custom", *values)
+
+def encode_file(task):
+    """Return the chunks for a file described by a (name, load, exe, data,
+    timing) sequence. This is used by the worker processes that encode files
+    in parallel for the UEFfile.import_files method."""
+
+    name, load, exe, data, timing = task
+    u = UEFfile()
+    u.timing = timing
+    return u.create_chunks(name, load, exe, data)
     
     
 class UEFfile:
@@ -49,7 +154,10 @@ class UEFfile:
     """
 
     def __init__(self, filename = None, creator = 'UEFfile '+version):
-        """Create a new instance of the UEFfile class."""
+        """Create a new instance of the UEFfile class.
+
+        The tones and gaps written around imported files use standard timing
+        unless the timing attribute is set to another TimingProfile."""
 
         if filename == None:
 
@@ -75,6 +183,11 @@ class UEFfile:
 
             # List of files
             self.contents = []
+            # Playing time of the chunks (calculated when needed)
+            self.tape_time = None
+
+            # Timing used for the tones and gaps of imported files
+            self.timing = standard_timing
         else:
             # Read in the chunks from the file
 
@@ -135,9 +248,13 @@ class UEFfile:
             # Read file contents (placed in the list attribute "contents").
             self.read_contents()
 
+            # Timing used for the tones and gaps of imported files
+            self.timing = standard_timing
+
 
     def write(self, filename, write_creator_info = True,
-              write_machine_info = True, write_emulator_info = True):
+              write_machine_info = True, write_emulator_info = True,
+              extra_chunks = None):
         """
         Write a UEF file containing all the information stored in an
         instance of UEFfile to the file with the specified filename.
@@ -145,6 +262,11 @@ class UEFfile:
         By default, information about the file's creator, target machine and
         emulator is written to the file. These can be omitted by calling this
         method with individual arguments set to False.
+
+        If extra_chunks is given, it is an iterable of chunks to be written
+        after the instance's own chunks, such as a generator returned by the
+        stream_chunks method. The chunks are written as they are produced
+        and are not added to the instance.
         """
 
         # Open the UEF file for writing
@@ -170,11 +292,29 @@ class UEFfile:
     
         # Write the chunks to the file
         self.write_chunks(uef)
+
+        if extra_chunks is not None:
+            self.write_chunks(uef, extra_chunks)
     
         # Close the file
         uef.close()
 
 
+    def writer(self, filename, write_creator_info = True,
+               write_machine_info = True, write_emulator_info = True,
+               flush_interval = 2.0):
+        """
+        Return a UEFwriter that writes a UEF file containing the information
+        stored in an instance of UEFfile, followed by any chunks written to
+        it, to the file with the specified filename. The arguments are used
+        in the same way as those of the write method.
+        """
+
+        return UEFwriter(filename, self, write_creator_info,
+                         write_machine_info, write_emulator_info,
+                         flush_interval)
+
+
     def number(self, size, n):
         """Convert a number to a little endian string of bytes for writing to a binary file."""
 
@@ -243,25 +383,17 @@ class UEFfile:
 
     def crc(self, s):
 
-        high = 0
-        low = 0
+        # This is equivalent to shifting each bit through the high and low
+        # bytes using the rol method, but uses a table to handle a byte at a
+        # time. The high and low bytes are swapped in the value returned.
+        value = 0
+        table = crc_table
 
         for i in s:
 
-            high = high ^ ord(i)
-
-            for j in range(0,8):
+            value = ((value << 8) & 0xff00) ^ table[(value >> 8) ^ ord(i)]
 
-                a, carry = self.rol(high, 0)
-
-                if carry == 1:
-                    high = high ^ 8
-                    low = low ^ 16
-
-                low, carry = self.rol(low, carry)
-                high, carry = self.rol(high, carry)
-
-        return high | (low << 8)
+        return (value >> 8) | ((value & 0xff) << 8)
 
     # CRC calculation routines (end)
 
@@ -270,6 +402,8 @@ class UEFfile:
         
         # List of files
         self.contents = []
+        # Playing time of the chunks (calculated when needed)
+        self.tape_time = None
         
         current_file = {}
         
@@ -346,6 +480,128 @@ class UEFfile:
             # 5) their start position (chunk number) in the archive
 
 
+    def chunk_times(self):
+        """
+        Returns a list containing the time in seconds at which each chunk
+        starts when the UEF file is played. The list contains one more entry
+        than there are chunks, holding the total playing time.
+
+        Data is assumed to be played at 1200 baud with a base frequency of
+        1200 Hz until changed by base frequency (0x113) or baud rate (0x117)
+        chunks. A UEFfile_error is raised for chunks too short to be timed.
+        """
+
+        # The shortest data that each timed chunk can hold
+        minimum_lengths = {0x110: 2, 0x111: 4, 0x112: 2, 0x113: 4,
+                           0x114: 5, 0x116: 4, 0x117: 2}
+
+        times = [0.0] * (len(self.chunks) + 1)
+        t = 0.0
+
+        base = 1200.0
+        baud = 1200.0
+        # Length of a bit and a cycle of high tone
+        bit_time = 1 / baud
+        tone_time = 0.5 / base
+
+        for i in xrange(len(self.chunks)):
+
+            times[i] = t
+            chunk_id, data = self.chunks[i]
+
+            if len(data) < minimum_lengths.get(chunk_id, 0):
+                raise UEFfile_error, 'Chunk %i (&%x) is too short.' % (
+                    i, chunk_id)
+
+            if chunk_id == 0x100 or chunk_id == 0x101:
+                # Each byte has a start bit and a stop bit
+                t = t + len(data) * 10 * bit_time
+
+            elif chunk_id == 0x102 or chunk_id == 0x103:
+                # The first byte holds the number of unused bits
+                if data:
+                    t = t + ((len(data) - 1) * 8 - ord(data[0])) * bit_time
+
+            elif chunk_id == 0x104:
+                # Packet format: data bits, parity and stop bits
+                if len(data) >= 3:
+                    stop_bits = struct.unpack("<b", data[2])[0]
+                    bits = 1 + ord(data[0]) + abs(stop_bits)
+                    if data[1] != 'N':
+                        bits = bits + 1
+                    t = t + (len(data) - 3) * bits * bit_time
+
+            elif chunk_id == 0x110:
+                t = t + self.str2num(2, data) * tone_time
+
+            elif chunk_id == 0x111:
+                # Tone either side of a dummy byte
+                t = t + (self.str2num(2, data[:2]) +
+                         self.str2num(2, data[2:4])) * tone_time
+                t = t + 10 * bit_time
+
+            elif chunk_id == 0x112:
+                t = t + self.str2num(2, data) * tone_time
+
+            elif chunk_id == 0x113:
+                base = struct.unpack("<f", data[:4])[0]
+                if base <= 0:
+                    raise UEFfile_error, \
+                          'Chunk %i (&%x) has no base frequency.' % (i, chunk_id)
+                bit_time = (1200.0 / baud) / base
+                tone_time = 0.5 / base
+
+            elif chunk_id == 0x114:
+                # Security cycles: a set bit is a cycle of high tone and a
+                # clear bit is a cycle of the base frequency
+                count = self.str2num(3, data[:3])
+                if len(data) < 5 + (count + 7) / 8:
+                    raise UEFfile_error, 'Chunk %i (&%x) is too short.' % (
+                        i, chunk_id)
+                ones = 0
+                for j in xrange(count):
+                    if ord(data[5 + j / 8]) & (0x80 >> (j % 8)):
+                        ones = ones + 1
+                t = t + (2 * count - ones) * tone_time
+
+            elif chunk_id == 0x116:
+                t = t + struct.unpack("<f", data[:4])[0]
+
+            elif chunk_id == 0x117:
+                baud = float(self.str2num(2, data))
+                if baud == 0:
+                    raise UEFfile_error, 'Chunk %i (&%x) has no baud rate.' % (
+                        i, chunk_id)
+                bit_time = (1200.0 / baud) / base
+
+        times[-1] = t
+        return times
+
+
+    def tape_duration(self):
+        """
+        Returns the total playing time of the UEF file in seconds.
+
+        The start time and duration of each file, in seconds, are stored in
+        the 'start time' and 'duration' entries of the contents list. These
+        are only calculated the first time they are needed after the contents
+        list has been read.
+        """
+
+        if self.tape_time is None:
+
+            times = self.chunk_times()
+
+            for file in self.contents:
+                file['start time'] = times[file['position']]
+                file['duration'] = times[file['last position'] + 1] - \
+                                   file['start time']
+
+            self.tape_time = times[-1]
+
+        return self.tape_time
+
+
     def chunk(self, f, n, data):
         """Write a chunk to the file specified by the open file object, chunk number and data supplied."""
 
@@ -472,41 +728,22 @@ class UEFfile:
         """Write data to a string as a file data block in preparation to be written
         as chunk data to a UEF file."""
 
-        # Write the alignment character
-        out = "*"+name[:10]+"\000"
-
-        # Load address
-        out = out + self.number(4, load)
-
-        # Execution address
-        out = out + self.number(4, exe)
-
-        # Block number
-        out = out + self.number(2, n)
-
-        # Block length
-        out = out + self.number(2, len(block))
-
         # Block flag (last block)
-        if flags:
-            out = out + self.number(1, flags)
-        elif last:
-            out = out + self.number(1, 128)
-        else:
-            out = out + self.number(1, 0)
-
-        # Next address
-        out = out + self.number(4, 0)
-
-        # Header CRC
-        out = out + self.number(2, self.crc(out[1:]))
-
-        out = out + block
+        if not flags:
+            if last:
+                flags = 128
+            else:
+                flags = 0
 
-        # Block CRC
-        out = out + self.number(2, self.crc(block))
+        # The alignment character is followed by the name, load and execution
+        # addresses, block number, block length, block flag and next address
+        header = "*" + name[:10] + "\000" + block_header.pack(
+            load & 0xffffffff, exe & 0xffffffff, n & 0xffff,
+            len(block) & 0xffff, flags & 0xff, 0)
 
-        return out
+        # The header and block are each followed by their CRCs
+        return "".join((header, block_crc.pack(self.crc(header[1:])),
+                        block, block_crc.pack(self.crc(block))))
 
 
     def get_leafname(self, path):
@@ -732,10 +969,14 @@ class UEFfile:
         self.chunk(file, 0xff00, emulator)
 
 
-    def write_chunks(self, file):
-        """Write all the chunks in the list to a file. Saves having loops in other functions to do this."""
+    def write_chunks(self, file, chunks = None):
+        """Write all the chunks in the list to a file. Saves having loops in other functions to do this.
+        If chunks is given, write the chunks it contains instead of those in the list."""
 
-        for c in self.chunks:
+        if chunks is None:
+            chunks = self.chunks
+
+        for c in chunks:
 
             self.chunk(file, c[0], c[1])
 
@@ -744,44 +985,87 @@ class UEFfile:
         """Create suitable chunks, and insert them into
         the list of chunks."""
 
-        # Reset the block number to zero
-        block_number = 0
+        # Each 256 byte block of the data is read through a view so that
+        # the rest of the data is not copied as each block is encoded
+        view = memoryview(data)
+        length = len(view)
 
-        # Long gap
-        gap = 1
+        # There is always at least one block, even for empty files, and
+        # each block is preceded by a tone
+        blocks = max(1, (length + 255) / 256)
+        new_chunks = [None] * (blocks * 2)
+
+        # Long gap before the first block, short gaps between the others
+        tone, short_tone = self.timing.tone_chunks()
+
+        offset = 0
+
+        for block_number in range(blocks):
+
+            end = offset + 256
+            block = self.write_block(view[offset:end].tobytes(), name, load,
+                                     exe, block_number, end >= length)
+
+            new_chunks[block_number * 2] = tone
+            new_chunks[block_number * 2 + 1] = (0x100, block)
+
+            tone = short_tone
+            offset = end
+
+        # Return the list of new chunks
+        return new_chunks
+
+
+    def stream_chunks(self, name, load, exe, f, gap = False,
+                      buffer_size = 65536):
+        """
+        Generate the chunks for a file with the given name, load and
+        execution addresses whose data is read from the file object f,
+        preceded by a gap if enabled. The data is read in pieces of
+        buffer_size bytes as the chunks are needed, so the memory used
+        does not depend on the size of the file.
+        """
+
+        if gap:
+            for chunk in self.timing.gap_chunks():
+                yield chunk
+
+        # Long gap before the first block, short gaps between the others
+        tone, short_tone = self.timing.tone_chunks()
+
+        buf = f.read(buffer_size)
+        offset = 0
+        block_number = 0
 
-        new_chunks = []
-    
-        # Write block details
         while True:
-        
-            last = (len(data) <= 256)
-            block = self.write_block(data[:256], name, load, exe, block_number,
-                                     last)
 
-            # Remove the leading 256 bytes as they have been encoded
-            data = data[256:]
+            # Keep more than one block's worth of data buffered until the
+            # end of the file so that the last block can be recognised
+            if len(buf) - offset <= 256:
+                buf = buf[offset:]
+                offset = 0
+                while len(buf) <= 256:
+                    more = f.read(buffer_size)
+                    if not more:
+                        break
+                    buf += more
 
-            if gap == 1:
-                new_chunks.append((0x110, self.number(2,0x05dc)))
-                gap = 0
-            else:
-                new_chunks.append((0x110, self.number(2,0x0258)))
+            end = offset + 256
+            last = end >= len(buf)
 
-            # Write the block to the list of new chunks
-            new_chunks.append((0x100, block))
+            yield tone
+            yield (0x100, self.write_block(buf[offset:end], name, load, exe,
+                                           block_number, last))
 
             if last:
                 break
 
-            # Increment the block number
+            tone = short_tone
+            offset = end
             block_number = block_number + 1
 
-        # Return the list of new chunks
-        return new_chunks
 
-
-    def import_files(self, file_position, info, gap = False):
+    def import_files(self, file_position, info, gap = False, processes = None):
         """
         Import a file, or series of files, into the UEF file at the specified
         file position in the list of contents. Each file will be preceded by
@@ -798,6 +1082,12 @@ class UEFfile:
             data is the contents of the file.
 
         For more than one file, info must be a sequence of info sequences.
+
+        If processes is given, the files are encoded in parallel by a pool
+        of that many worker processes, or one for each processor if it is
+        zero. The chunks produced are the same as when the files are
+        encoded one at a time, but the create_chunks method of a subclass
+        is not used by the workers.
         """
 
         if file_position < 0:
@@ -834,16 +1124,26 @@ class UEFfile:
 
         # Read the file details for each file and create chunks to add
         # to the list of chunks
+        if processes is None:
+            file_chunks = [self.create_chunks(name, load, exe, data)
+                           for name, load, exe, data in info]
+        else:
+            pool = multiprocessing.Pool(processes or None)
+            try:
+                file_chunks = pool.map(encode_file,
+                    [tuple(details) + (self.timing,) for details in info])
+            finally:
+                pool.close()
+                pool.join()
+
         inserted_chunks = []
 
-        for name, load, exe, data in info:
+        for new_chunks in file_chunks:
 
             if gap:
-                inserted_chunks += [(0x112, "\xdc\x05"),
-                                    (0x110, "\xdc\x05"),
-                                    (0x100, "\xdc")]
-            
-            inserted_chunks += self.create_chunks(name, load, exe, data)
+                inserted_chunks += self.timing.gap_chunks()
+
+            inserted_chunks += new_chunks
 
         # Insert the chunks in the list at the specified position
         self.chunks = self.chunks[:position] + inserted_chunks + self.chunks[position:]
@@ -1140,3 +1440,93 @@ class UEFfile:
             n = n + 1
 
         print
+
+
+class UEFwriter:
+    """writer = UEFwriter(filename, uef)
+
+    Write a UEF file a chunk at a time, using the header information and
+    chunks of the UEFfile instance given, so that chunks can be written as
+    they are produced instead of being collected in memory.
+
+    Chunks are compressed and written to the file when the flush method is
+    called, when the flush interval in seconds has passed since they were
+    last written, and when the writer is closed. Each time the chunks are
+    written they form a complete gzip member, so the file can be read up to
+    the last chunks written even if the writer is never closed.
+    """
+
+    def __init__(self, filename, uef, write_creator_info = True,
+                 write_machine_info = True, write_emulator_info = True,
+                 flush_interval = 2.0):
+
+        try:
+            self.file = open(filename, 'wb')
+        except IOError:
+            raise UEFfile_error, "Couldn't open %s for writing." % filename
+
+        self.filename = filename
+        self.uef = uef
+        self.flush_interval = flush_interval
+        self.pending = cStringIO.StringIO()
+
+        # Write the UEF file header and information chunks
+        uef.write_uef_header(self.pending)
+
+        if write_creator_info:
+            uef.write_uef_creator(self.pending)
+
+        if write_machine_info:
+            uef.write_machine_info(self.pending)
+
+        if write_emulator_info:
+            uef.write_emulator_info(self.pending)
+
+        uef.write_chunks(self.pending)
+        self.flush()
+
+
+    def write_chunk(self, chunk):
+        """Write a chunk, given as a tuple containing the chunk number and
+        data, to the file."""
+
+        self.uef.chunk(self.pending, chunk[0], chunk[1])
+
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+
+    def write_chunks(self, chunks):
+        """Write all the chunks in the list to the file."""
+
+        for c in chunks:
+
+            self.write_chunk(c)
+
+
+    def flush(self):
+        """Compress the chunks written since the last flush and write them
+        to the file."""
+
+        data = self.pending.getvalue()
+
+        if data:
+
+            try:
+                member = gzip.GzipFile(self.filename, 'wb', fileobj = self.file)
+                member.write(data)
+                member.close()
+                self.file.flush()
+            except IOError:
+                raise UEFfile_error, "Couldn't write to %s." % self.filename
+
+            self.pending = cStringIO.StringIO()
+
+        self.last_flush = time.time()
+
+
+    def close(self):
+        """Write any remaining chunks and close the file."""
+
+        self.flush()
+        self.file.close()
@@ -17,9 +17,15 @@ GNU General Public License for more details.
 
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+UEFtrans.py needs the UEFfile module, which provides the timing profiles
+and the chunks used when adding files. Keep UEFfile.py in the same
+directory or install it with setup.py.
 """
 
-import sys, string, os, gzip
+import sys, string, os, posixpath, gzip, stat, tarfile, tempfile, zipfile, zlib
+import UEFfile
+from multiprocessing.pool import ThreadPool
 
 __version__ = '0.42 (Wed 19th November 2003)'
 
@@ -117,12 +123,15 @@ def chunk(f, n, data):
     f.write(data)
 
 
-def read_block(chunk):
-    """t = read_block(chunk)
+def read_block(chunk, verify = True):
+    """t = read_block(chunk, verify = True)
     
     Read a data block from a tape chunk and return the program name, load
     and execution addresses, block data, block number and whether the block
     is supposedly the last in the file.
+    
+    If verify is False then the block's CRC is not checked and the data is
+    taken directly using the block length in the header.
     """
     
     # Chunk number and data
@@ -219,6 +228,13 @@ def read_block(chunk):
     else:
         last = 0
     
+    if not verify:
+    
+        # Take the data using the length given in the block header.
+        length = str2num(2, block[a+10:a+12])
+        return (name, load, exec_addr, block[a+19:a+19+length],
+                block_number, last)
+    
     # Try to cope with UEFs that contain junk data at the end of blocks.
     rest = block[a+19:][:258]
     bad_crc = False
@@ -242,57 +258,38 @@ def read_block(chunk):
     return (name, load, exec_addr, data, block_number, last)
 
 
-def write_block(f, name, load, exe, length, n):
-    """write_block(file, name, load, exe, length, n)
+def find_option(args, label, number = 0):
+    """found = find_option(args, label)
+    found, values = find_option(args, label, number)
     
-    Read data from a file and write it to a string as a file data block in
-    preparation to be written as chunk data to a UEF file.
+    Match an option in a list of command line arguments, removing it and any
+    arguments it takes from the list. For options without arguments, return
+    a single boolean value. For options with arguments, return a boolean value
+    and the argument (if only one is expected) or a list of arguments. The
+    boolean value is False if the option or its arguments were not found.
     """
     
-    block = f.read(256)
-    
-    # Write the alignment character.
-    out = "*"+name[:10]+"\000"
-    
-    # Load address
-    out = out + number(4, load)
-    
-    # Execution address
-    out = out + number(4, exe)
-    
-    # Block number
-    out = out + number(2, n)
-    
-    # Block length
-    out = out + number(2, len(block))
-    
-    # Block flag (last block)
-    if f.tell() == length:
-        out = out + number(1, 128)
-        last = 1
-    else:
-        if len(block) == 256:
-            out = out + number(1, 0)
-            last = 0
+    try:
+        i = args.index(label)
+    except ValueError:
+        if number == 0:
+            return False
         else:
-            out = out + number(1, 128) # shouldn't be needed 
-            last = 1 
+            return False, None
     
-    # Next address
-    out = out + number(2, 0)
+    values = args[i + 1:i + number + 1]
+    args[:] = args[:i] + args[i + number + 1:]
     
-    # Unknown
-    out = out + number(2, 0)
+    if number == 0:
+        return True
     
-    # Header CRC
-    out = out + number(2, crc(out[1:]))
+    if len(values) < number:
+        return False, values
     
-    out = out + block
+    if number == 1:
+        values = values[0]
     
-    # Block CRC
-    out = out + number(2, crc(block))
-    
-    return out, last
+    return True, values
 
 
 def get_leafname(path):
@@ -543,24 +540,85 @@ def write_chunks(file, chunks):
         chunk(file, c[0], c[1])
 
 
-def create_chunks(file_names, gaps = True):
-    """create_chunks(file_names, gaps = True)
+def open_temporary(path):
+    """temp_path, file = open_temporary(path)
     
-    Traverse the list of filenames to insert, reading the relevant
-    information, creating suitable chunks, and inserting them into
-    the list of chunks. If gaps is True then insert a gap before
-    each file.
+    Create a temporary file in the same directory as the file with the path
+    given and open it for writing as a gzip-compressed file, so that it can
+    replace that file once it has been written. The temporary file is given
+    the permissions of the original file.
     """
     
-    new_chunks = []
+    directory, leafname = os.path.split(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(prefix = leafname + '.',
+                                         dir = directory)
+    os.close(handle)
+    
+    try:
+        os.chmod(temp_path, stat.S_IMODE(os.stat(path).st_mode))
+        return temp_path, gzip.open(temp_path, 'wb')
+    except (IOError, OSError):
+        os.remove(temp_path)
+        raise
+
+
+def replace_file(temp_path, path):
+    """replace_file(temp_path, path)
+    
+    Rename the file with the temporary path given to replace the file with
+    the other path given.
+    """
+    
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        # Files cannot be renamed over existing files on some platforms.
+        os.remove(path)
+        os.rename(temp_path, path)
+
+
+def parse_inf(details, name):
+    """real_name, load, exe = parse_inf(details, name)
+    
+    Parse the details read from the first line of the .inf file for the file
+    with the name given, returning the name to be stored in the archive and
+    the load and execution addresses. Raise ValueError if the details cannot
+    be understood.
+    """
+    
+    # Split the details up where whitespace characters occur.
+    details = string.split(details)
+    
+    # Examine the name entry and take the load and execution addresses.
+    if details and string.find(details[0], '.') != -1:
+        real_name = details[0][string.find(details[0], '.')+1:]
+        addresses = details[1:3]
+    else:
+        real_name = get_leafname(name)
+        addresses = details[0:2]
+    
+    if len(addresses) < 2:
+        raise ValueError, 'missing load or execution address'
+    
+    load = int(addresses[0], 16)
+    exe = int(addresses[1], 16)
+    
+    return real_name, load, exe
+
+
+def read_file_details(file_names):
+    """details = read_file_details(file_names)
+    
+    Read the .inf files for the list of filenames to insert, returning a list
+    of tuples containing each filename, the name to use in the archive, and
+    the load and execution addresses. Exit if any of the files or their .inf
+    files cannot be read.
+    """
+    
+    details_list = []
     
     for name in file_names:
     
-        if gaps:
-            new_chunks += [(0x112, "\xdc\x05"),
-                           (0x110, "\xdc\x05"),
-                           (0x100, "\xdc")]
-        
         # Find the .inf file and read the details stored within
         try:
             details = open(name + suffix + 'inf', 'r').readline()
@@ -572,102 +630,239 @@ def create_chunks(file_names, gaps = True):
                 print "Couldn't open information file, %s" % name+suffix+'inf'
                 sys.exit()
         
-        # Parse the details
-        details = [string.rstrip(details)]
-        
-        splitters = [' ', '\011']
-        
-        # Split the details up where certain whitespace characters occur
-        for s in splitters:
-        
-            new_details = []
-            
-            # Split up each substring (list entry)
-            for d in details:
-            
-                new_details = new_details + string.split(d, s)
-            
-            details = new_details
-        
-        details = filter(lambda s: s, details)
-        
         # We should have details about the load and execution addresses
+        try:
+            real_name, load, exe = parse_inf(details, name)
+        except ValueError:
+            print 'Problem with %s: information is possibly incorrect.' % \
+                name+suffix+'inf'
+            
+            sys.exit()
         
-        # Open the file
+        # Check that the file can be opened
         try:
-            in_file = open(name, 'rb')
+            open(name, 'rb').close()
         except IOError:
             print "Couldn't open file, %s" % name
             sys.exit()
         
-        # Find the length of the file (don't rely on the .inf file)
-        in_file.seek(0, 2)
-        length = in_file.tell()
-        in_file.seek(0, 0)
+        details_list.append((name, real_name, load, exe))
+    
+    return details_list
+
+
+def stream_chunks(details_list, gaps = True, timing = UEFfile.standard_timing):
+    """for chunk in stream_chunks(details_list, gaps = True,
+                                  timing = UEFfile.standard_timing):
+    
+    Generate the chunks for the files described by the list returned by the
+    read_file_details function, reading each file in large pieces as the
+    chunks are needed so that the files never need to be held in memory.
+    If gaps is True then insert a gap before each file. The lengths of gaps
+    and tones are taken from the timing profile given. Raise IOError if a
+    file cannot be opened or read.
+    """
+    
+    # The chunks for each file are generated by UEFfile using the timing
+    # profile given.
+    uef = UEFfile.UEFfile()
+    uef.timing = timing
+    
+    for name, real_name, load, exe in details_list:
+    
+        # Open the file
+        try:
+            in_file = open(name, 'rb', 65536)
+        except IOError:
+            raise IOError, "Couldn't open file, %s" % name
         
-        # Examine the name entry and take the load and execution addresses.
-        dot_at = string.find(details[0], '.')
-        if dot_at != -1:
-            real_name = details[0][dot_at+1:]
-            load, exe = details[1], details[2]
-        else:
-            real_name = get_leafname(name)
-            load, exe = details[0], details[1]
+        for chunk in uef.stream_chunks(real_name, load, exe, in_file, gaps):
+            yield chunk
         
-        load = int(load, 16)
-        exe = int(exe, 16)
+        # Close the input file.
+        in_file.close()
+    
+    # Write some finishing bytes to the list of new chunks
+#    new_chunks.append((0x110, number(2,0x0258)))
+#    new_chunks.append((0x112, number(2,0x0258)))
+
+
+def create_chunks(file_names, gaps = True, timing = UEFfile.standard_timing):
+    """create_chunks(file_names, gaps = True,
+                     timing = UEFfile.standard_timing)
+    
+    Traverse the list of filenames to insert, reading the relevant
+    information, creating suitable chunks, and inserting them into
+    the list of chunks. If gaps is True then insert a gap before
+    each file. The lengths of gaps and tones are taken from the timing
+    profile given.
+    """
+    
+    # Return the list of new chunks
+    try:
+        return list(stream_chunks(read_file_details(file_names), gaps, timing))
+    except IOError, exc:
+        print str(exc)
+        sys.exit()
+
+
+def read_library(path):
+    """files, errors = read_library(path)
+    
+    Find the files and their .inf files in a directory tree, or in a tar or
+    zip archive, with the path given. Return an iterator over tuples
+    containing the name of each file, its name in a UEF archive, its load
+    and execution addresses and its data, sorted by name, and a list that
+    the iterator fills with tuples containing the name of each file that
+    could not be read and a description of the problem.
+    
+    Each file is only read when the iterator reaches it, so only one file is
+    held in memory at a time.
+    """
+    
+    if os.path.isdir(path):
+    
+        names = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                names.append(os.path.join(dirpath, filename))
         
-        if load == None or exe == None:
-            print 'Problem with %s: information is possibly incorrect.' % \
-                name+suffix+'inf'
-            
-            sys.exit()
+        def read(name):
+            return open(name, 'rb').read()
         
-        # Reset the block number to zero.
-        block_number = 0
+        close = lambda: None
+        leafname = get_leafname
+        splitext = os.path.splitext
+    
+    elif tarfile.is_tarfile(path):
+    
+        archive = tarfile.open(path)
+        members = {}
         
-        # Long gap
-        gap = 1
+        for member in archive.getmembers():
+            if member.isfile():
+                members[member.name] = member
         
-        # Write block details.
-        while 1:
-            block, last = write_block(
-                in_file, real_name, load, exe, length, block_number
-                )
-            
-            if gap == 1:
-            
-                new_chunks.append((0x110, number(2,0x05dc)))
-                gap = 0
-            
-            else:
-            
-                new_chunks.append((0x110, number(2,0x0258)))
-            
-            # Write the block to the list of new chunks.
-            
-            if UEF_major == 0 and UEF_minor < 9:
+        names = members.keys()
+        
+        def read(name):
+            return archive.extractfile(members[name]).read()
+        
+        close = archive.close
+        leafname = lambda name: name[string.rfind(name, '/')+1:]
+        # Members of archives use the Unix path conventions.
+        splitext = posixpath.splitext
+    
+    elif zipfile.is_zipfile(path):
+    
+        archive = zipfile.ZipFile(path)
+        names = filter(lambda name: name[-1:] != '/', archive.namelist())
+        
+        read = archive.read
+        close = archive.close
+        leafname = lambda name: name[string.rfind(name, '/')+1:]
+        splitext = posixpath.splitext
+    
+    else:
+        raise IOError, "Couldn't read files from %s" % path
+    
+    # Separate the .inf files from the files they describe.
+    infs = {}
+    files = []
+    
+    for name in names:
+    
+        root, extension = splitext(name)
+        if string.lower(extension[1:]) == 'inf':
+            infs[root] = name
+        else:
+            files.append(name)
+    
+    files.sort()
+    errors = []
+    
+    return library_files(files, infs, read, close, leafname, errors), errors
+
+
+# Exceptions raised by the read functions used by library_files for files
+# that cannot be read, including damaged and encrypted members of archives.
+library_errors = (IOError, zipfile.BadZipfile, tarfile.TarError, zlib.error,
+                  RuntimeError)
+
+def library_files(names, infs, read, close, leafname, errors):
+    """for name, real_name, load, exe, data in library_files(names, infs,
+                                    read, close, leafname, errors):
+    
+    Read each of the files with the names given and its .inf file, whose
+    name is found in the infs dictionary, using the read function, and
+    yield its details. Problems are added to the list of errors. The close
+    function is called after the last file has been read.
+    """
+    
+    try:
+        for name in names:
+        
+            if not infs.has_key(name):
+                errors.append((name, 'no information file'))
+                continue
             
-                # For old versions, just write the block.
-                new_chunks.append((0x100, block))
+            try:
+                details = string.split(read(infs[name]), '\n')[0]
+            except library_errors, exc:
+                errors.append((name,
+                    "couldn't read the information file (%s)" % exc))
+                continue
             
-            else:
-                new_chunks.append((0x100, block))
+            try:
+                real_name, load, exe = parse_inf(details, leafname(name))
+            except ValueError:
+                errors.append((name, 'information is possibly incorrect'))
+                continue
             
-            if last == 1:
-                break
+            try:
+                data = read(name)
+            except library_errors, exc:
+                errors.append((name, "couldn't read the file (%s)" % exc))
+                continue
             
-            # Increment the block number.
-            block_number = block_number + 1
+            yield (name, real_name, load, exe, data)
         
-        # Close the input file.
-        in_file.close()
+        # Report .inf files that do not describe any file.
+        found = {}
+        for name in names:
+            found[name] = 1
+        
+        for name in infs.keys():
+            if not found.has_key(name):
+                errors.append((infs[name], 'no file to describe'))
     
-    # Write some finishing bytes to the list of new chunks
-#    new_chunks.append((0x110, number(2,0x0258)))
-#    new_chunks.append((0x112, number(2,0x0258)))
+    finally:
+        close()
+
+
+def import_chunks(files, gaps = True, timing = UEFfile.standard_timing):
+    """chunks = import_chunks(files, gaps = True,
+                              timing = UEFfile.standard_timing)
+    
+    Create chunks for the files returned by read_library in a single pass.
+    If gaps is True then insert a gap before each file. The lengths of gaps
+    and tones are taken from the timing profile given.
+    """
+    
+    # The chunks for each file are created by UEFfile using the timing
+    # profile given.
+    uef = UEFfile.UEFfile()
+    uef.timing = timing
+    
+    new_chunks = []
+    
+    for name, real_name, load, exe, data in files:
+    
+        if gaps:
+            new_chunks += timing.gap_chunks()
+        
+        new_chunks += uef.create_chunks(real_name, load, exe, data)
     
-    # Return the list of new chunks
     return new_chunks
 
 
@@ -736,13 +931,14 @@ def encode_chunks(file_names):
     return new_chunks
 
 
-def export_file(out_path, chunks, name, write_name, load, exe, length):
+def export_file(out_path, name, write_name, load, exe, data):
 
-    """export_file(out_path, chunks, name, write_name, load, exe, length)
+    """export_file(out_path, name, write_name, load, exe, data)
     
-    Export the list of chunks given as a file on the path specified with
-    the name given as write_name. The original name is also supplied for
-    use in .inf files.
+    Export the data given as a file on the path specified with the name
+    given as write_name. The original name is also supplied for use in .inf
+    files. The data is taken from the contents of the archive, so the blocks
+    in the file do not need to be read again.
     """
     
     out_file = inf_file = None
@@ -779,31 +975,14 @@ def export_file(out_path, chunks, name, write_name, load, exe, length):
     if inf_file != None:
     
         # Write information to the .inf file
-        inf_file.write('$.%s\t%x\t%x\t%x\n' % (name, load, exe, length))
-        
-        # Read the blocks from the UEF file and write
-        # them to the file
-        position = 0
-        end_pos = len(chunks)
-        while position < end_pos:
-        
-            # Find the next block
-            position = find_next_block(chunks, position)
-            
-            if position == None:
-            
-                break
-            
-            else:
-                # Read the block information.
-                name, load, exec_addr, data, block_number, last = \
-                    read_block(chunks[position])
-                
-                # Store the data in the file.
-                out_file.write(data)
-            
-            position = position + 1
+        inf_file.write('$.%s\t%x\t%x\t%x\n' % (name, load, exe, len(data)))
+        inf_file.close()
         
+        # Store the data in the file.
+        out_file.write(data)
+    
+    if out_file != None:
+    
         # Close the file.
         out_file.close()
 
@@ -901,6 +1080,14 @@ def browsable(s):
     return new
 
 
+def format_time(seconds):
+
+    """Returns the number of seconds given as a string of the form mm:ss.s."""
+
+    minutes = int(seconds / 60)
+    return '%02i:%04.1f' % (minutes, seconds - minutes * 60)
+
+
 def print_help(command):
 
     if command == 'general':
@@ -916,12 +1103,25 @@ def print_help(command):
         print '        wwwinfo <directory>'
         print '        new <machine> <keyboard>'
         print '        cat'
+        print '        times'
         print '        append <files>'
+        print '        import <directory/tar file/zip file>'
         print '        insert <position> <files/chunks>'
         print '        remove <positions>'
         print '        extract <positions> <directory>'
         print '        chunks'
         print
+        print 'Block CRCs are checked when files are read from the archive. The'
+        print '--noverify option can be given with any command to skip these checks'
+        print 'and read each block using the length given in its header.'
+        print
+        print 'The tones and gaps written around files added to the archive follow'
+        print 'standard Acorn timing unless the --timing option is given with'
+        print '"turbo" for short tones and gaps suitable for emulators, or four'
+        print 'comma-separated hexadecimal values giving the number of cycles of'
+        print 'tone before the first block of a file, the number before each'
+        print 'other block, and the lengths of the gap and tone before each file.'
+        print
         print 'In addition, the help command provides information on any command'
         print 'and uses the special syntax:'
         print
@@ -959,6 +1159,15 @@ def print_help(command):
         print '        Lists the names of the files in the archive.'
         print
     
+    elif command == 'times':
+    
+        print times_syntax
+        print
+        print '        Lists the time at which each file in the archive starts'
+        print '        and the time taken to load it, followed by the total'
+        print '        playing time of the archive.'
+        print
+    
     elif command == 'append':
     
         print append_syntax
@@ -967,6 +1176,16 @@ def print_help(command):
         print '        archive. Each file requires an associated .inf file.'
         print
     
+    elif command == 'import':
+    
+        print import_syntax
+        print
+        print '        Add all the files found in the directory, tar file or zip'
+        print '        file given to the end of the archive. Each file requires an'
+        print '        associated .inf file. Files that cannot be imported are'
+        print '        reported and the remaining files are still added.'
+        print
+    
     elif command == 'insert':
     
         print insert_syntax
@@ -1033,6 +1252,10 @@ def print_help(command):
         print '        Extract files/chunks at the comma separated positions'
         print '        specified and either save them in the directory given with'
         print '        .inf files or add them to the end of the UEF file given.'
+        print '        Use "all" as the position to extract every file.'
+        print
+        print '        Files saved in a directory are written using a number of'
+        print '        threads which can be set with the --threads option.'
         print
         print '        To extract files, use the numbers of the file in the'
         print '        archive catalogue. To extract chunks, supply the positions'
@@ -1123,10 +1346,12 @@ if __name__ == '__main__':
     add_syntax = base_syntax + 'add <files>'
     insert_syntax = base_syntax + 'insert <position> <files>'
     append_syntax = base_syntax + 'append <files>'
+    import_syntax = base_syntax + 'import <directory/tar file/zip file>'
     remove_syntax = base_syntax + 'remove <positions>'
-    extract_syntax = base_syntax + 'extract <positions> <directory/UEF file>'
+    extract_syntax = base_syntax + 'extract [--threads <number>] <positions> <directory/UEF file>'
     info_syntax = base_syntax + 'info'
     cat_syntax = base_syntax + 'cat'
+    times_syntax = base_syntax + 'times'
     chunks_syntax = base_syntax + 'chunks'
     wwwinfo_syntax = base_syntax + 'wwwinfo <directory>'
     
@@ -1183,6 +1408,22 @@ if __name__ == '__main__':
     
     args = args[2:]
     
+    # Block CRCs are checked when reading files unless this option is given.
+    verify = not find_option(args, '--noverify')
+    
+    # The tones and gaps around new files use standard timing unless another
+    # profile is given.
+    use_timing, timing = find_option(args, '--timing', 1)
+    
+    if use_timing:
+        try:
+            timing = UEFfile.get_timing_profile(timing)
+        except UEFfile.UEFfile_error, exc:
+            print str(exc)
+            sys.exit()
+    else:
+        timing = UEFfile.standard_timing
+    
     
     # Originator, target machine and keyboard layout is initially undefined.
     originator = target_machine = keyboard_layout = 'Unknown'
@@ -1265,7 +1506,18 @@ if __name__ == '__main__':
     
     if command == 'extract':
     
-        if len(args) < 2:
+        use_threads, threads = find_option(args, '--threads', 1)
+        
+        try:
+            if use_threads:
+                threads = int(threads)
+            else:
+                threads = 4
+        except ValueError:
+            print extract_syntax
+            sys.exit()
+        
+        if len(args) < 2 or threads < 1:
         
             print extract_syntax
             sys.exit()
@@ -1584,12 +1836,14 @@ if __name__ == '__main__':
         
             # Read the block information.
             name, load, exec_addr, data, block_number, last = \
-                read_block(chunks[position])
+                read_block(chunks[position], verify)
             
             if current_file == {}:
             
-                # No current file, so store details.
-                current_file = {'name': name, 'load': load, 'exec': exec_addr, 'blocks': block_number, 'data': data}
+                # No current file, so store details. The data from each
+                # block is collected in a list and joined when the file is
+                # complete.
+                current_file = {'name': name, 'load': load, 'exec': exec_addr, 'blocks': block_number, 'data': [data]}
                 
                 # Locate the first non-block chunk before the block
                 # and store the position of the file.
@@ -1617,7 +1871,7 @@ if __name__ == '__main__':
                     current_file = \
                     {
                         'name': name, 'load': load, 'exec': exec_addr,
-                        'blocks': block_number, 'data': data
+                        'blocks': block_number, 'data': [data]
                     }
                     
                     # Locate the first non-block chunk before the block
@@ -1634,7 +1888,7 @@ if __name__ == '__main__':
                     # blocks and append the block data to the
                     # data entry.
                     current_file['blocks'] = block_number
-                    current_file['data'] = current_file['data'] + data
+                    current_file['data'].append(data)
                     
                     # Update the last position information to mark the end of
                     # the file.
@@ -1643,6 +1897,9 @@ if __name__ == '__main__':
             # Increase the position.
             position = position + 1
     
+    # Join the data from the blocks of each file.
+    for file in contents:
+        file['data'] = string.join(file['data'], '')
     
     
     # We now have a contents list which tells us:
@@ -1690,6 +1947,49 @@ if __name__ == '__main__':
         # Exit
         sys.exit()
     
+    # Playing time command
+    
+    if command == 'times':
+    
+        # Time the chunks already read, using the positions of the files
+        # found above.
+        uef = UEFfile.UEFfile()
+        uef.chunks = chunks
+        
+        try:
+            times = uef.chunk_times()
+        except UEFfile.UEFfile_error, exc:
+            print str(exc)
+            sys.exit()
+        
+        for file in contents:
+            file['start time'] = times[file['position']]
+            file['duration'] = times[file['last position'] + 1] - \
+                               file['start time']
+        
+        total = times[-1]
+        
+        print 'Playing times of %s:' % uef_file
+        
+        file_number = 0
+        
+        for file in contents:
+        
+            print string.ljust(str(file_number), 3)+': ' + \
+                  string.ljust(printable(file['name']), 16) + \
+                  '%s  %s' % (
+                      format_time(file['start time']),
+                      format_time(file['duration'])
+                      )
+            
+            file_number = file_number + 1
+        
+        print
+        print 'Total: '+format_time(total)
+        
+        # Exit
+        sys.exit()
+    
     
     # Detailed information command (wwwinfo)
     
@@ -1959,7 +2259,7 @@ if __name__ == '__main__':
             file_names = string.split(args[1], ',')
             
             # Insert the chunks in the list at the specified position
-            chunks = chunks[:position] + create_chunks(file_names) + \
+            chunks = chunks[:position] + create_chunks(file_names, True, timing) + \
                 chunks[position:]
         
         # Open the UEF file for writing.
@@ -1995,24 +2295,101 @@ if __name__ == '__main__':
         # Names of files to insert (comma-separated list)
         file_names = string.split(args[0], ',')
         
-        # Put the new file chunks after all the other chunks.
-        chunks = chunks + create_chunks(file_names)
+        # Check the files before the archive is overwritten.
+        details_list = read_file_details(file_names)
         
-        # Open the UEF file for writing.
+        # Open a temporary file for writing, so that the UEF file is only
+        # replaced once all the files have been read.
         try:
-            uef = gzip.open(uef_file, 'wb')
-        except IOError:
+            temp_path, uef = open_temporary(uef_file)
+        except (IOError, OSError):
             print "Couldn't open %s for writing." % uef_file
             sys.exit()
         
-        # Write the UEF file header.
-        write_uef_header(uef, UEF_major, UEF_minor)
+        try:
+            # Write the UEF file header.
+            write_uef_header(uef, UEF_major, UEF_minor)
+            
+            # Write the chunks to the file, followed by the new file chunks
+            # as they are encoded.
+            write_chunks(uef, chunks)
+            write_chunks(uef, stream_chunks(details_list, True, timing))
+            
+            # Close the file and put it in place of the UEF file.
+            uef.close()
+            replace_file(temp_path, uef_file)
+        
+        except IOError, exc:
+            # Leave the UEF file unchanged.
+            uef.close()
+            os.remove(temp_path)
+            print str(exc)
+            sys.exit()
         
-        # Write the chunks to the file.
-        write_chunks(uef, chunks)
+        except:
+            uef.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
         
-        # Close the file.
-        uef.close()
+        # Exit
+        sys.exit()
+    
+    
+    # Import command
+    
+    if command == 'import':
+    
+        if len(args) != 1:
+        
+            # The directory or archive containing the files must be given.
+            print import_syntax
+            sys.exit()
+        
+        # Find the files and their information.
+        try:
+            files, errors = read_library(args[0])
+        except library_errors, exc:
+            print str(exc)
+            sys.exit()
+        
+        # Open a temporary file for writing, so that the UEF file is only
+        # replaced once all the files have been read.
+        try:
+            temp_path, uef = open_temporary(uef_file)
+        except (IOError, OSError):
+            print "Couldn't open %s for writing." % uef_file
+            sys.exit()
+        
+        try:
+            # Write the UEF file header.
+            write_uef_header(uef, UEF_major, UEF_minor)
+            
+            # Write the chunks to the file, then put the new file chunks
+            # after them, reading and encoding one file at a time.
+            write_chunks(uef, chunks)
+            
+            imported = 0
+            for file in files:
+                write_chunks(uef, import_chunks([file], True, timing))
+                imported = imported + 1
+            
+            # Close the file and put it in place of the UEF file.
+            uef.close()
+            replace_file(temp_path, uef_file)
+        
+        except:
+            # Leave the UEF file unchanged.
+            uef.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        
+        print 'Imported %i files.' % imported
+        
+        # Report any files that could not be imported.
+        for name, problem in errors:
+            print "Couldn't import %s: %s." % (name, problem)
         
         # Exit
         sys.exit()
@@ -2021,7 +2398,10 @@ if __name__ == '__main__':
     if command == 'extract':
     
         # File positions of files to extract
-        positions = string.split(args[0], ',')
+        if args[0] == 'all':
+            positions = map(str, range(len(contents)))
+        else:
+            positions = string.split(args[0], ',')
         
         # Destination path in which to put the files (any directories
         # should have already been created).
@@ -2037,6 +2417,14 @@ if __name__ == '__main__':
 #            print 'There are no files to extract.'
 #            sys.exit()
         
+        # Files written to a directory are exported by a pool of threads
+        # using the data already read into the contents list. They are
+        # collected in a dictionary so that, as when they were written one
+        # at a time, the last of any files with the same name is the one
+        # that is kept.
+        exports = {}
+        export_order = []
+        
         # There are files already present.
         
         for position in positions:
@@ -2111,13 +2499,33 @@ if __name__ == '__main__':
                         write_name = printable(name)
                         load = contents[file_position]['load']
                         exe = contents[file_position]['exec']
-                        length = len(contents[file_position]['data'])
+                        data = contents[file_position]['data']
                         
-                        export_file(
-                            out_path, chunks[start_pos:end_pos+1], name,
-                            write_name, load, exe, length
+                        if not exports.has_key(write_name):
+                            export_order.append(write_name)
+                        
+                        exports[write_name] = (
+                            out_path, name, write_name, load, exe, data
                             )
         
+        if exports:
+        
+            # Write the files and wait for all of them to be written.
+            pool = ThreadPool(min(threads, len(exports)))
+            
+            results = []
+            for write_name in export_order:
+                results.append(
+                    pool.apply_async(export_file, exports[write_name])
+                    )
+            
+            pool.close()
+            
+            for result in results:
+                result.get()
+            
+            pool.join()
+        
         if string.lower(out_path[-4:]) == suffix+'uef':
         
             # Close destination UEF file.
@@ -0,0 +1,838 @@
+"""
+audioUEF.py - Support for reading and filtering audio for recordUEF.py and
+fftUEF.py.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import io, os, struct, sys, time
+import numpy as np
+
+# The number of frames read from an audio file at a time
+buffer_frames = 65536
+
+# The number of frames read from a stream at a time, which limits the delay
+# before audio arriving from a live recording is decoded
+stream_frames = 4096
+
+def read_samples(audio_f, format, step, frames = buffer_frames):
+
+    """Reads frames from the audio file, described by the struct format and
+    size in bytes given, yielding arrays of floating point values containing
+    the first sample of each frame. Any incomplete frame at the end of the
+    file is ignored."""
+
+    if isinstance(audio_f, WavFile):
+        for values in audio_f.read_samples(frames):
+            yield values
+        return
+
+    if isinstance(audio_f, AudioStream):
+        for values in audio_f.read_samples():
+            yield values
+        return
+
+    dtype = np.dtype(format[0] + format[1])
+    channels = step / dtype.itemsize
+
+    while True:
+
+        data = audio_f.read(frames * step)
+        if not data:
+            break
+
+        # Drop any incomplete frame at the end of the data.
+        length = (len(data) / step) * step
+        if length == 0:
+            break
+
+        values = np.frombuffer(data[:length], dtype = dtype)
+        yield values[::channels].astype(np.float64)
+
+
+def read_wav_format(fmt):
+
+    """Returns a dictionary describing the audio format held in the string
+    containing the format chunk of a WAV file. Raises IOError if the format
+    is not supported."""
+
+    if len(fmt) < 16:
+        raise IOError("Not a WAV file I understand.")
+
+    tag, channels, sample_rate, byte_rate, block_align, bits = \
+        struct.unpack("<HHIIHH", fmt[:16])
+
+    # The extensible format holds the real format at the start of its
+    # sub-format GUID.
+    if tag == 0xfffe and len(fmt) >= 26:
+        tag = struct.unpack("<H", fmt[24:26])[0]
+
+    if tag not in (1, 3) or channels == 0:
+        raise IOError("Unsupported WAV format (%i)." % tag)
+
+    return {"floating": tag == 3, "channels": channels,
+            "sample_rate": sample_rate, "block_align": block_align,
+            "sample_size": bits}
+
+
+def convert_samples(values, sample_size, floating):
+
+    """Returns the array of samples given, read from a WAV file with the
+    sample size and type given, as floating point values in the range of
+    signed 8-bit values for unsigned 8-bit samples and in the range of
+    signed 16-bit values otherwise."""
+
+    values = values.astype(np.float64)
+
+    if floating:
+        return values * 32767
+    elif sample_size == 8:
+        return values - 128
+    elif sample_size == 32:
+        return values / 65536.0
+    else:
+        return values
+
+
+def convert_24bit(b):
+
+    """Returns the 24-bit samples held in the rows of three bytes in the
+    array given as floating point values in the range of signed 16-bit
+    values."""
+
+    b = b.astype(np.int32)
+    values = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+    values = np.where(values >= 0x800000, values - 0x1000000, values)
+    return values / 256.0
+
+
+def read_wav_header(f):
+
+    """Reads the chunks of a RIFF WAVE file from the start of the open file
+    given, returning a dictionary describing the format of the audio and the
+    position and length in bytes of its data. Chunks other than the format
+    and data chunks, such as LIST and fact chunks, are skipped. Raises
+    IOError if the file is not a WAV file that can be understood."""
+
+    f.seek(0, 0)
+    header = f.read(12)
+
+    if len(header) < 12 or header[:4] != "RIFF" or header[8:] != "WAVE":
+        raise IOError("Not a WAV file I understand.")
+
+    f.seek(0, 2)
+    file_size = f.tell()
+    position = 12
+    details = {}
+
+    while position + 8 <= file_size:
+
+        f.seek(position, 0)
+        chunk_id = f.read(4)
+        size = struct.unpack("<I", f.read(4))[0]
+
+        if chunk_id == "fmt ":
+
+            details.update(read_wav_format(f.read(size)))
+
+        elif chunk_id == "data":
+
+            if "channels" not in details:
+                raise IOError("Not a WAV file I understand.")
+
+            # Recordings that were not finished may have an invalid size.
+            details["data_offset"] = position + 8
+            details["data_size"] = min(size, file_size - position - 8)
+            return details
+
+        # Chunks are padded to an even number of bytes.
+        position = position + 8 + size + (size & 1)
+
+    raise IOError("Not a WAV file I understand.")
+
+
+class WavFile:
+
+    """Provides access to a channel of the audio in a WAV file through a
+    memory map of the file.
+
+    Samples are returned as floating point values. Unsigned 8-bit samples are
+    converted to the range of signed 8-bit values and all other sample sizes
+    and floating point samples are converted to the range of signed 16-bit
+    values, matching the values read from raw audio files.
+    """
+
+    def __init__(self, path, channel = 0):
+
+        f = open(path, "rb")
+        try:
+            details = read_wav_header(f)
+        finally:
+            f.close()
+
+        self.channels = details["channels"]
+        self.sample_rate = details["sample_rate"]
+        self.sample_size = details["sample_size"]
+        self.floating = details["floating"]
+        self.channel = min(channel, self.channels - 1)
+
+        block_align = details["block_align"]
+        self.frames = details["data_size"] / block_align
+        self.position = 0
+
+        if self.frames == 0:
+            self.data = np.zeros((0, self.channels))
+            return
+
+        if self.floating:
+            dtype = {32: "<f4", 64: "<f8"}.get(self.sample_size)
+        else:
+            dtype = {8: "u1", 16: "<i2", 32: "<i4"}.get(self.sample_size)
+
+        if dtype is None and (self.floating or self.sample_size != 24):
+            raise IOError("Unsupported WAV sample size (%i)." % self.sample_size)
+
+        if self.sample_size == 24:
+            # There is no 24-bit type, so map the bytes of each frame.
+            self.data = np.memmap(path, dtype = np.uint8, mode = "r",
+                                  offset = details["data_offset"],
+                                  shape = (self.frames, block_align))
+        else:
+            self.data = np.memmap(path, dtype = dtype, mode = "r",
+                                  offset = details["data_offset"],
+                                  shape = (self.frames, block_align / np.dtype(dtype).itemsize))
+
+    def close(self):
+
+        """Releases the memory map of the file."""
+
+        self.data = np.zeros((0, self.channels))
+        self.frames = 0
+        self.position = 0
+
+    def seek(self, frame):
+
+        """Sets the frame from which samples are read."""
+
+        self.position = max(0, min(frame, self.frames))
+
+    def samples(self, start, end):
+
+        """Returns an array of the samples in the channel from the start frame
+        up to, but not including, the end frame."""
+
+        if self.sample_size == 24:
+            return convert_24bit(
+                self.data[start:end, 3 * self.channel:3 * self.channel + 3])
+
+        return convert_samples(self.data[start:end, self.channel],
+                               self.sample_size, self.floating)
+
+    def read_samples(self, frames = buffer_frames):
+
+        """Yields arrays of samples from the current frame to the end of the
+        data."""
+
+        while self.position < self.frames:
+
+            end = min(self.position + frames, self.frames)
+            values = self.samples(self.position, end)
+            self.position = end
+            yield values
+
+
+class AudioStream:
+
+    """Reads a channel of audio from a file that cannot seek, such as a pipe
+    from a recording program, so that audio of any length can be decoded as
+    it arrives using a constant amount of memory.
+
+    Data is read directly into a buffer holding the given number of frames,
+    which is reused for each array of samples produced, with any incomplete
+    frame at the end of the buffer moved to its start before the next read.
+    Each array of samples is produced when the buffer is full, or at the end
+    of the file, so the size of the buffer limits the delay between audio
+    arriving and being decoded.
+
+    The stream contains raw audio, described using set_raw_format, or a WAV
+    file, read using read_wav_header.
+    """
+
+    def __init__(self, f, frames = stream_frames):
+
+        self.raw = io.FileIO(f.fileno(), "r", closefd = False)
+        self.frames = frames
+        self.pending = ""
+
+        self.buffer = None
+        self.used = 0
+
+    def read(self, size):
+
+        """Returns a string containing the given number of bytes, or fewer
+        if the end of the file is reached."""
+
+        data = [self.pending[:size]]
+        self.pending = self.pending[size:]
+        size -= len(data[0])
+
+        while size > 0:
+            chunk = self.raw.read(size)
+            if not chunk:
+                break
+            data.append(chunk)
+            size -= len(chunk)
+
+        return "".join(data)
+
+    def unread(self, data):
+
+        """Returns the string of bytes given to the start of the stream."""
+
+        self.pending = data + self.pending
+
+    def read_wav_header(self, channel = 0):
+
+        """Reads the chunks at the start of a WAV file up to the start of its
+        data, setting the format of the samples to be read from the channel
+        given. The size of the data is ignored, since programs writing to a
+        pipe cannot know it, so samples are read until the end of the file.
+        Raises IOError if the WAV file cannot be understood."""
+
+        header = self.read(12)
+        if header[:4] != "RIFF" or header[8:] != "WAVE":
+            raise IOError("Not a WAV file I understand.")
+
+        details = None
+
+        while True:
+
+            chunk = self.read(8)
+            if len(chunk) < 8:
+                raise IOError("Not a WAV file I understand.")
+
+            chunk_id = chunk[:4]
+            size = struct.unpack("<I", chunk[4:])[0]
+
+            if chunk_id == "data":
+                break
+
+            data = self.read(size + (size & 1))
+            if chunk_id == "fmt ":
+                details = read_wav_format(data[:size])
+
+        if details is None:
+            raise IOError("Not a WAV file I understand.")
+
+        self.sample_rate = details["sample_rate"]
+        self.sample_size = details["sample_size"]
+        self.floating = details["floating"]
+
+        if self.floating:
+            dtype = {32: "<f4", 64: "<f8"}.get(self.sample_size)
+        elif self.sample_size == 24:
+            # There is no 24-bit type, so read the bytes of each frame.
+            dtype = ("u1", 3)
+        else:
+            dtype = {8: "u1", 16: "<i2", 32: "<i4"}.get(self.sample_size)
+
+        if dtype is None:
+            raise IOError("Unsupported WAV sample size (%i)." % self.sample_size)
+
+        self.set_format(dtype, details["channels"], channel)
+
+    def set_raw_format(self, format, step, channel = 0):
+
+        """Sets the format of the samples in a stream of raw audio, using
+        the struct format and frame size in bytes given, to be read from the
+        channel given."""
+
+        dtype = np.dtype(format[0] + format[1])
+
+        # Raw samples are used as they are read.
+        self.sample_size = None
+        self.floating = False
+        self.set_format(dtype, step / dtype.itemsize, channel)
+
+    def set_format(self, dtype, channels, channel):
+
+        self.dtype = np.dtype(dtype)
+        self.channels = channels
+        self.channel = min(channel, channels - 1)
+        self.frame_size = self.dtype.itemsize * channels
+
+        self.buffer = bytearray(self.frames * self.frame_size)
+        self.view = memoryview(self.buffer)
+
+        # Place any data already read at the start of the buffer.
+        self.used = len(self.pending)
+        self.buffer[:self.used] = self.pending
+        self.pending = ""
+
+    def fill(self):
+
+        """Reads data into the buffer until it is full or the end of the
+        file is reached, returning the number of bytes in the buffer."""
+
+        end = self.used
+        while end < len(self.buffer):
+            count = self.raw.readinto(self.view[end:])
+            if not count:
+                break
+            end += count
+
+        return end
+
+    def skip(self, frames):
+
+        """Reads and discards the given number of frames, returning the
+        number of frames skipped, which is smaller than the number requested
+        if the end of the file is reached."""
+
+        skipped = 0
+
+        while skipped < frames:
+
+            end = self.fill()
+            available = end / self.frame_size
+            if available == 0:
+                break
+
+            used = min(available, frames - skipped) * self.frame_size
+            self.buffer[:end - used] = self.buffer[used:end]
+            self.used = end - used
+            skipped += used / self.frame_size
+
+        return skipped
+
+    def read_samples(self):
+
+        """Yields arrays of samples from the current frame to the end of the
+        file."""
+
+        while True:
+
+            end = self.fill()
+            length = (end / self.frame_size) * self.frame_size
+            if length == 0:
+                break
+
+            values = np.frombuffer(self.buffer, dtype = self.dtype,
+                                   count = length / self.dtype.itemsize)
+            values = values[self.channel::self.channels]
+
+            if self.sample_size is None:
+                values = values.astype(np.float64)
+            elif self.sample_size == 24:
+                values = convert_24bit(values)
+            else:
+                values = convert_samples(values, self.sample_size,
+                                         self.floating)
+
+            # Keep any incomplete frame for the next read.
+            self.buffer[:end - length] = self.buffer[length:end]
+            self.used = end - length
+
+            yield values
+
+
+def filled(value, n):
+
+    """Returns a new array of n floating point values containing the value
+    or array of values given."""
+
+    a = np.empty(n, dtype = np.float64)
+    a[:] = value
+    return a
+
+
+def scan(b, c, x0, lower = None, upper = None):
+
+    """Returns an array containing the values of x produced by the recurrence
+    x[n] = b[n] * x[n - 1] + c[n], starting from a previous value of x0. If
+    lower and upper bounds are given, each new value is clamped to them before
+    being used in the next step.
+
+    Each step is a function of the form clamp(b*x + c, lower, upper) and the
+    composition of two such functions has the same form, so the values can be
+    calculated with a logarithmic number of passes over whole arrays instead
+    of a pass over each element in turn.
+    """
+
+    c = np.array(c, dtype = np.float64)
+    n = len(c)
+
+    b = filled(b, n)
+
+    clamped = lower is not None
+    if clamped:
+        lo = filled(lower, n)
+        hi = filled(upper, n)
+
+    s = 1
+    while s < n:
+
+        # Compose each function with the one covering the preceding values.
+        b1, c1 = b[:-s], c[:-s]
+        b2, c2 = b[s:], c[s:]
+
+        new_c = b2 * c1 + c2
+
+        if clamped:
+            lo1, hi1 = lo[:-s], hi[:-s]
+            lo2, hi2 = lo[s:], hi[s:]
+            a = b2 * lo1 + c2
+            z = b2 * hi1 + c2
+            new_lo = np.clip(np.minimum(a, z), lo2, hi2)
+            new_hi = np.clip(np.maximum(a, z), lo2, hi2)
+            lo[s:] = new_lo
+            hi[s:] = new_hi
+
+        b[s:] = b2 * b1
+        c[s:] = new_c
+        s = s * 2
+
+    x = b * x0 + c
+    if clamped:
+        x = np.clip(x, lo, hi)
+
+    return x
+
+
+def rc_filter(values, V0, a, lower = -1.0, upper = 1.0):
+
+    """Returns the voltages over the capacitor of an RC filter with the
+    applied voltages given, starting from a voltage of V0, where a is the
+    ratio of the sample period to the time constant of the filter. The
+    voltages are clamped to the lower and upper limits given."""
+
+    return scan(1.0 - a, a * values, V0, lower, upper)
+
+
+def rc_filters_loop(values, V1, a1, V2, a2, lower, upper, out1, out2):
+
+    """Applies two clamped RC filters to the values given, the second to the
+    output of the first, starting from voltages of V1 and V2 over their
+    capacitors, and writes the voltages after each value to the out1 and out2
+    arrays. This is compiled by Numba when it is available."""
+
+    b1 = 1.0 - a1
+    b2 = 1.0 - a2
+
+    for i in range(values.shape[0]):
+
+        V1 = b1 * V1 + a1 * values[i]
+        if V1 < lower:
+            V1 = lower
+        elif V1 > upper:
+            V1 = upper
+
+        V2 = b2 * V2 + a2 * V1
+        if V2 < lower:
+            V2 = lower
+        elif V2 > upper:
+            V2 = upper
+
+        out1[i] = V1
+        out2[i] = V2
+
+
+def load_filter_kernel(name = None):
+
+    """Selects the implementation used by rc_filters, returning its name.
+
+    If a name is given, that implementation is used: "numba" for the loop
+    compiled by Numba, "c" for the library built from rcfilter.c and loaded
+    with ctypes, "numpy" for the scans over whole arrays performed by
+    rc_filter, or "python" for the loop run by the interpreter. Otherwise
+    the first of the compiled implementations that is available is used,
+    falling back to the scans. Raises ImportError if the implementation
+    requested is not available.
+
+    This is called by rc_filters the first time it is used. The library for
+    the "c" implementation is built with "python setup.py build_kernel"."""
+
+    global filter_kernel, _kernel
+
+    if name in (None, "numba"):
+        try:
+            import numba
+            _kernel = numba.njit(rc_filters_loop)
+            filter_kernel = "numba"
+            return filter_kernel
+        except ImportError:
+            pass
+
+    if name in (None, "c"):
+
+        import ctypes
+
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for library_name in ("rcfilter.so", "rcfilter.dylib", "rcfilter.dll"):
+            path = os.path.join(directory, library_name)
+            if os.path.exists(path):
+                break
+        else:
+            path = None
+
+        if path:
+            library = ctypes.CDLL(path)
+            array = np.ctypeslib.ndpointer(dtype = np.float64,
+                                           flags = "C_CONTIGUOUS")
+            function = library.rc_filters
+            function.restype = None
+            function.argtypes = [array, ctypes.c_long,
+                ctypes.c_double, ctypes.c_double,
+                ctypes.c_double, ctypes.c_double,
+                ctypes.c_double, ctypes.c_double, array, array]
+
+            _kernel = lambda values, V1, a1, V2, a2, lower, upper, out1, out2: \
+                function(values, len(values), V1, a1, V2, a2, lower, upper,
+                         out1, out2)
+            filter_kernel = "c"
+            return filter_kernel
+
+    if name in (None, "numpy"):
+        _kernel = None
+        filter_kernel = "numpy"
+        return filter_kernel
+
+    if name == "python":
+        _kernel = rc_filters_loop
+        filter_kernel = "python"
+        return filter_kernel
+
+    raise ImportError("The %s filter kernel is not available." % name)
+
+
+def rc_filters(values, V1, a1, V2, a2, lower = -1.0, upper = 1.0):
+
+    """Returns arrays containing the voltages over the capacitors of two RC
+    filters, where the first is applied to the voltages given and the second
+    to the output of the first, starting from voltages of V1 and V2. The
+    ratios of the sample period to the time constants of the filters are a1
+    and a2 and the voltages are clamped to the lower and upper limits given.
+
+    The filters are run by the kernel chosen by load_filter_kernel."""
+
+    if filter_kernel is None:
+        load_filter_kernel()
+
+    if _kernel is None:
+        Vc1 = rc_filter(values, V1, a1, lower, upper)
+        return Vc1, rc_filter(Vc1, V2, a2, lower, upper)
+
+    values = np.ascontiguousarray(values, dtype = np.float64)
+    Vc1 = np.empty(len(values))
+    Vc2 = np.empty(len(values))
+    _kernel(values, float(V1), float(a1), float(V2), float(a2),
+            float(lower), float(upper), Vc1, Vc2)
+
+    return Vc1, Vc2
+
+
+# The name of the implementation used by rc_filters, chosen when it is first
+# used unless load_filter_kernel is called before then
+filter_kernel = None
+_kernel = None
+
+
+class Progress:
+
+    """Reports the time reached in an audio file while it is being read.
+
+    Reports are made no more often than the interval given, in seconds of
+    wall-clock time, or, if a stride is given, each time that many seconds of
+    audio have been read. If a callback is given, it is called with the time
+    reached instead of writing a report to the stream, which is sys.stderr
+    unless another is given. The format function is used to convert a time
+    in seconds to the text written.
+    """
+
+    def __init__(self, interval = 0.5, stride = None, callback = None,
+                 stream = None, format = None):
+
+        self.interval = interval
+        self.stride = stride
+        self.callback = callback
+        self.stream = stream or sys.stderr
+        self.format = format or (lambda t: "%.2f" % t)
+
+        self.last_time = None
+        self.last_T = None
+        self.written = False
+
+    def update(self, T):
+
+        if self.stride is not None:
+            if self.last_T is not None and T - self.last_T < self.stride:
+                return
+            self.last_T = T
+        else:
+            now = time.time()
+            if self.last_time is not None and now - self.last_time < self.interval:
+                return
+            self.last_time = now
+
+        if self.callback:
+            self.callback(T)
+        else:
+            self.stream.write("\r%s " % self.format(T))
+            self.stream.flush()
+            self.written = True
+
+    def finish(self):
+
+        """Ends the line of reports written to the stream, if any."""
+
+        if self.written:
+            self.stream.write("\n")
+            self.written = False
+
+
+class PulseFinder:
+
+    """Finds pulses in arrays of filtered values, none of which are negative,
+    keeping track of any pulse still in progress at the end of an array so
+    that it can be completed by the next one.
+
+    A pulse starts when the values rise from zero and ends when they next fall
+    to zero. It is only complete when the values then stay at zero for more
+    than zero_count samples; if they rise again before that, the pulse is
+    extended to the next fall.
+    """
+
+    def __init__(self, zero_count):
+
+        self.zero_count = zero_count
+        self.reset()
+
+    def reset(self):
+
+        """Forgets any pulse in progress."""
+
+        self.old_y = 0.0
+        # The start and end times of the pulse in progress
+        self.start_t = None
+        self.end_t = None
+        # The peak value since the start of the pulse
+        self.ymax = 0.0
+        # The number of zero values since the end of the pulse
+        self.zeros = 0
+
+    def find(self, y, T0, dt):
+
+        """Returns arrays containing the index, centre time, width and peak
+        value of each pulse completed in the array of values y, where the
+        first value occurs at time T0 and subsequent values are dt apart."""
+
+        n = len(y)
+        zero_count = self.zero_count
+
+        previous = np.empty(n)
+        previous[0] = self.old_y
+        previous[1:] = y[:-1]
+
+        positive = y > 0
+        nonzero = np.flatnonzero(positive)
+        rises = np.flatnonzero((previous == 0) & positive)
+        falls = np.flatnonzero((previous > 0) & ~positive)
+
+        # Find the end of the run of zeros that follows each fall.
+        following = np.append(nonzero, n)
+        run_ends = following[np.searchsorted(nonzero, falls)]
+        ended = (run_ends - falls) > zero_count
+        ends = falls[ended]
+        triggers = ends + zero_count
+
+        # A pulse may be completed by the zeros at the start of the array.
+        leading = None
+        if self.zeros > 0 and self.zeros + following[0] > zero_count:
+            leading = zero_count - self.zeros
+
+        # Each pulse starts at the first rise after the previous pulse was
+        # completed unless it was already in progress.
+        if leading is not None:
+            previous_triggers = np.append(leading, triggers[:-1])
+        else:
+            previous_triggers = np.append(-1, triggers[:-1])
+
+        starts = rises[np.searchsorted(rises, previous_triggers,
+                                       side = "right")] if len(rises) else \
+                 np.zeros(len(triggers), dtype = np.int64)
+        carried = leading is None and self.start_t is not None and \
+                  len(triggers) > 0
+
+        # Find the peak value in each pulse after its first value.
+        y_ext = np.append(y, 0.0)
+        bounds = np.empty(2 * len(triggers), dtype = np.int64)
+        bounds[0::2] = starts + 1
+        bounds[1::2] = ends + 1
+        if carried:
+            bounds[0] = 0
+
+        if len(triggers) > 0:
+            peaks = np.maximum.reduceat(y_ext, bounds)[0::2]
+        else:
+            peaks = np.zeros(0)
+
+        start_times = T0 + starts * dt
+        end_times = T0 + ends * dt
+
+        if carried:
+            start_times[0] = self.start_t
+            peaks[0] = max(peaks[0], self.ymax)
+
+        if leading is not None:
+            triggers = np.append(leading, triggers)
+            start_times = np.append(self.start_t, start_times)
+            end_times = np.append(self.end_t, end_times)
+            peaks = np.append(self.ymax, peaks)
+
+        # Record the state of any pulse in progress at the end of the array.
+        if len(triggers) > 0:
+            last = triggers[-1]
+        else:
+            last = -1
+
+        later_rises = rises[rises > last]
+        later_falls = falls[falls > last]
+
+        if len(triggers) == 0 and self.start_t is not None:
+            # The pulse in progress continues.
+            self.ymax = max(self.ymax, y.max())
+            if len(later_falls) > 0:
+                self.end_t = T0 + later_falls[-1] * dt
+        elif len(later_rises) > 0:
+            # A new pulse has started.
+            self.start_t = T0 + later_rises[0] * dt
+            self.ymax = y_ext[later_rises[0] + 1:].max()
+            if len(later_falls) > 0 and later_falls[-1] > later_rises[0]:
+                self.end_t = T0 + later_falls[-1] * dt
+        else:
+            self.start_t = None
+            self.ymax = 0.0
+
+        # Count the zeros following the end of any pulse in progress.
+        if self.start_t is None or y[-1] != 0:
+            self.zeros = 0
+        elif len(later_falls) > 0:
+            self.zeros = n - later_falls[-1]
+        else:
+            self.zeros = self.zeros + n
+
+        self.old_y = y[-1]
+
+        return triggers, (start_times + end_times) / 2.0, \
+               end_times - start_times, peaks
@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+
+"""
+benchUEF.py - Measure the performance of the UEF handling code.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json, multiprocessing, os, resource, sys, tempfile, time
+import UEFfile
+
+def find_option(args, label, number = 0):
+
+    """Matches an option in a list of command line arguments, returning a
+    single boolean value for options without arguments and a tuple for options
+    with arguments.
+
+    For options with arguments, the tuple contains a boolean value and a list
+    of arguments found unless only one argument is expected, in which case the
+    value itself is included in the tuple instead of a list.
+
+    If the boolean value is True, the option was found. If it is False then
+    either it was not found or the required number of arguments was not found.
+    """
+
+    try:
+        i = args.index(label)
+    except ValueError:
+        if number == 0:
+            return False
+        else:
+            return False, None
+
+    values = args[i + 1:i + number + 1]
+    args[:] = args[:i] + args[i + number + 1:]
+
+    if number == 0:
+        return True
+
+    if len(values) < number:
+        return False, values
+
+    if number == 1:
+        values = values[0]
+
+    return True, values
+
+
+def best_time(function, args, repeat):
+
+    """Calls the function with the arguments given the specified number of
+    times, returning the shortest time taken by a call."""
+
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        function(*args)
+        times.append(time.time() - t0)
+
+    return min(times)
+
+
+def bench_encode(sizes, repeat):
+
+    """Measures the time taken to encode files of each of the sizes given, in
+    kilobytes, as chunks for a UEF file."""
+
+    u = UEFfile.UEFfile()
+
+    print "Encoding files as blocks (best of %i)" % repeat
+
+    for size in sizes:
+
+        data = os.urandom(size * 1024)
+        t = best_time(u.create_chunks, ("BENCH", 0x1900, 0x8023, data), repeat)
+        print "%6i KB: %8.4f s  %8.1f KB/s" % (size, t, size / t)
+
+
+def bench_import(sizes, files, processes, repeat):
+
+    """Measures the time taken to import the given number of files of each of
+    the sizes given, in kilobytes, into a UEF file, first one at a time and
+    then using a pool of processes."""
+
+    print "Importing %i files (best of %i)" % (files, repeat)
+
+    for size in sizes:
+
+        info = [("FILE%i" % i, 0x1900, 0x8023, os.urandom(size * 1024))
+                for i in range(files)]
+
+        t_serial = best_time(
+            lambda: UEFfile.UEFfile().import_files(0, info), (), repeat)
+        t_parallel = best_time(
+            lambda: UEFfile.UEFfile().import_files(0, info,
+                                                   processes = processes),
+            (), repeat)
+
+        print "%6i KB: %8.4f s serial  %8.4f s parallel  %5.2fx" % (
+            size, t_serial, t_parallel, t_serial / t_parallel)
+
+
+def bench_decode(path, repeat):
+
+    """Measures the time taken to decode the audio in the WAV file given,
+    or in a WAV file rendered from the UEF file given, and reports the real
+    time factor: the length of the audio divided by the time taken."""
+
+    import wave
+    import recordUEF, renderUEF
+
+    temp_path = None
+
+    if path.lower().endswith(".uef"):
+
+        fd, temp_path = tempfile.mkstemp(suffix = ".wav")
+        os.close(fd)
+
+        u = UEFfile.UEFfile(path)
+        audio_f = wave.open(temp_path, "wb")
+        audio_f.setnchannels(1)
+        audio_f.setsampwidth(2)
+        audio_f.setframerate(44100)
+
+        for samples in renderUEF.Renderer(44100).render(u.chunks):
+            audio_f.writeframesraw(renderUEF.convert(samples, 16))
+
+        audio_f.close()
+        path = temp_path
+
+    w = wave.open(path, "rb")
+    duration = w.getnframes() / float(w.getframerate())
+    w.close()
+
+    def decode():
+
+        audio_f = open(path, "rb")
+        mono, sample_rate, sample_size = recordUEF.check_wav(audio_f, True,
+                                                             None, None)
+        if sample_size == 8:
+            format = "<b"
+        else:
+            format = "<h"
+
+        reader = recordUEF.Reader(format, sample_size / 8, sample_rate, 1.0,
+                                  1200.0, 1200.0, 1/3200.0, 1/7000.0, 6200,
+                                  False, False, True, False)
+        reader.start_at(0.0)
+        blocks = 0
+        for block in reader.read_block(audio_f):
+            blocks = blocks + 1
+
+        audio_f.close()
+
+    try:
+        print "Decoding %.1f seconds of audio (best of %i)" % (duration, repeat)
+        t = best_time(decode, (), repeat)
+        print "%8.4f s  %8.1fx real time" % (t, duration / t)
+    finally:
+        if temp_path:
+            os.remove(temp_path)
+
+
+def expected_blocks(u):
+
+    """Returns a dictionary mapping the name and number of each block in the
+    UEF file given to the data it contains."""
+
+    blocks = {}
+
+    for chunk in u.chunks:
+        if chunk[0] == 0x100 and chunk[1][:1] == "*":
+            name, load, exe, data, number, last = u.read_block(chunk)
+            blocks[(name, number)] = data
+
+    return blocks
+
+
+def synthesise(u, sample_rate, noise, flutter, dc, seed = 0):
+
+    """Returns an array of samples, with values between -1 and 1, for the
+    chunks of the UEF file given, rendered at the sample rate given and then
+    degraded. The noise level and DC offset are fractions of full scale. The
+    flutter is the largest change in tape speed, as a percentage, made by a
+    slow wow at 0.5 Hz plus a quarter of that amount of flutter at 10 Hz."""
+
+    import numpy as np
+    import renderUEF
+
+    samples = np.concatenate(list(renderUEF.Renderer(sample_rate).render(u.chunks)))
+
+    if flutter:
+        # Read the rendered samples at a varying speed.
+        t = np.arange(len(samples)) / float(sample_rate)
+        speed = 1.0 + (flutter / 100.0) * (np.sin(2 * np.pi * 0.5 * t) +
+                                           np.sin(2 * np.pi * 10 * t) / 4)
+        positions = np.cumsum(speed) - speed[0]
+        positions = positions[positions <= len(samples) - 1]
+        samples = np.interp(positions, np.arange(len(samples)), samples)
+
+    if noise:
+        random = np.random.RandomState(seed)
+        samples = samples + random.normal(0.0, noise, len(samples))
+
+    return np.clip(samples + dc, -1.0, 1.0)
+
+
+def corpus_decode(path, decoder, repeat):
+
+    """Decodes the WAV file given with the decoder given the specified number
+    of times, returning the shortest time taken, the increase in the peak
+    memory used by the process in kilobytes, the blocks decoded, as tuples
+    containing their names, numbers and data, the number of failures and
+    the message for any error that stopped the decoding."""
+
+    import audioUEF, fftUEF, recordUEF
+
+    # The decoders report their progress on stdout, which is restored
+    # afterwards so that the process can be used again.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+
+    try:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        times = []
+
+        for i in range(repeat):
+
+            wav = audioUEF.WavFile(path)
+            found = []
+            failures = 0
+            error = None
+
+            t0 = time.time()
+
+            if decoder == "record":
+                reader = recordUEF.Reader("<h", 2, wav.sample_rate, 1.0,
+                                          1200.0, 1200.0, 1/3200.0, 1/7000.0,
+                                          6200, False, False, True, False)
+                reader.resilient = True
+            else:
+                reader = fftUEF.Reader("<h", 2, float(wav.sample_rate),
+                                       decoder)
+
+            reader.start_at(0.0)
+
+            try:
+                for block in reader.read_block(wav):
+                    found.append((block.name, block.number, block.block))
+            except Exception, exc:
+                error = "%s: %s" % (exc.__class__.__name__, exc)
+
+            times.append(time.time() - t0)
+            wav.close()
+
+            failures = len(reader.failures)
+            if error:
+                failures = failures + 1
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak
+
+    return min(times), peak, found, failures, error
+
+
+def bench_corpus(paths, rates, noise_levels, flutters, offsets, decoders,
+                 repeat, out = sys.stdout):
+
+    """Renders each of the UEF files given with every combination of the
+    sample rates, noise levels, amounts of flutter and DC offsets given,
+    decodes the audio with each of the decoders and returns two lists of
+    dictionaries, one per decoding. The first describes the blocks that each
+    decoder recovered, which only depend on the inputs and the decoders. The
+    second describes the speed of each decoder and the memory it used. A
+    table of the results is written to the output stream given."""
+
+    import wave
+    import renderUEF
+
+    results = []
+    timings = []
+
+    print >>out, "%-12s %6s %5s %5s %5s %-8s %9s %8s %9s %9s" % (
+        "File", "Rate", "Noise", "Flut.", "DC", "Decoder", "Samples/s",
+        "Realtime", "Memory", "Blocks")
+
+    for path in paths:
+
+        u = UEFfile.UEFfile(path)
+        expected = expected_blocks(u)
+
+        for sample_rate in rates:
+            for noise in noise_levels:
+                for flutter in flutters:
+                    for dc in offsets:
+
+                        samples = synthesise(u, sample_rate, noise, flutter, dc)
+                        duration = len(samples) / float(sample_rate)
+
+                        fd, temp_path = tempfile.mkstemp(suffix = ".wav")
+                        os.close(fd)
+
+                        audio_f = wave.open(temp_path, "wb")
+                        audio_f.setnchannels(1)
+                        audio_f.setsampwidth(2)
+                        audio_f.setframerate(sample_rate)
+                        audio_f.writeframes(renderUEF.convert(samples, 16))
+                        audio_f.close()
+
+                        frames = len(samples)
+                        del samples
+
+                        try:
+                            for decoder in decoders:
+
+                                # Decode in a new process so that its peak
+                                # memory use can be measured.
+                                pool = multiprocessing.Pool(1)
+                                try:
+                                    t, peak, found, failures, error = pool.apply(
+                                        corpus_decode, (temp_path, decoder, repeat))
+                                finally:
+                                    pool.terminate()
+
+                                recovered = set()
+                                for name, number, data in found:
+                                    if expected.get((name, number)) == data:
+                                        recovered.add((name, number))
+
+                                case = {
+                                    "file": os.path.basename(path),
+                                    "sample_rate": sample_rate,
+                                    "noise": noise,
+                                    "flutter": flutter,
+                                    "dc_offset": dc,
+                                    "decoder": decoder
+                                    }
+
+                                result = dict(case)
+                                result.update({
+                                    "duration": round(duration, 3),
+                                    "samples": frames,
+                                    "blocks_expected": len(expected),
+                                    "blocks_decoded": len(found),
+                                    "blocks_recovered": len(recovered),
+                                    "failures": failures,
+                                    "error": error
+                                    })
+                                results.append(result)
+
+                                timing = dict(case)
+                                timing.update({
+                                    "time": round(t, 4),
+                                    "samples_per_second": int(frames / t),
+                                    "real_time_factor": round(duration / t, 2),
+                                    "peak_memory_kb": peak
+                                    })
+                                timings.append(timing)
+
+                                print >>out, "%-12s %6i %5.2f %5.2f %5.2f %-8s %9i %7.1fx %6i KB %4i/%-4i" % (
+                                    result["file"][:12], sample_rate, noise,
+                                    flutter, dc, decoder,
+                                    timing["samples_per_second"],
+                                    timing["real_time_factor"], peak,
+                                    len(recovered), len(expected))
+                        finally:
+                            os.remove(temp_path)
+
+    return results, timings
+
+
+def usage(program_name):
+
+    sys.stderr.write(
+        "Usage: %s encode [--sizes <comma-separated sizes in KB>] "
+        "[--repeat <number>]\n"
+        "       %s import [--sizes <comma-separated sizes in KB>] "
+        "[--files <number>] [--processes <number>] [--repeat <number>]\n"
+        "       %s decode [--repeat <number>] <WAV file or UEF file>\n"
+        "       %s corpus [--rates <comma-separated rates in Hz>] "
+        "[--noise <comma-separated levels>] "
+        "[--flutter <comma-separated percentages>] "
+        "[--dc <comma-separated offsets>] "
+        "[--decoders <comma-separated names>] [--json <file>] "
+        "[--repeat <number>] <UEF file>...\n" % (
+        program_name, program_name, program_name, program_name))
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    program_name, args = sys.argv[0], sys.argv[1:]
+
+    use_repeat, repeat = find_option(args, "--repeat", 1)
+    use_sizes, sizes = find_option(args, "--sizes", 1)
+    use_files, files = find_option(args, "--files", 1)
+    use_processes, processes = find_option(args, "--processes", 1)
+    use_rates, rates = find_option(args, "--rates", 1)
+    use_noise, noise_levels = find_option(args, "--noise", 1)
+    use_flutter, flutters = find_option(args, "--flutter", 1)
+    use_dc, offsets = find_option(args, "--dc", 1)
+    use_decoders, decoders = find_option(args, "--decoders", 1)
+    use_json, json_file = find_option(args, "--json", 1)
+
+    if len(args) < 1:
+        usage(program_name)
+
+    if use_repeat:
+        repeat = int(repeat)
+    else:
+        repeat = 3
+
+    command = args[0]
+
+    if command not in ("decode", "corpus") and len(args) != 1:
+        usage(program_name)
+
+    if command == "encode":
+
+        if use_sizes:
+            sizes = map(int, sizes.split(","))
+        else:
+            sizes = [64, 256, 512]
+
+        bench_encode(sizes, repeat)
+
+    elif command == "import":
+
+        if use_sizes:
+            sizes = map(int, sizes.split(","))
+        else:
+            sizes = [16, 64]
+
+        if use_files:
+            files = int(files)
+        else:
+            files = 64
+
+        if use_processes:
+            processes = int(processes)
+        else:
+            processes = 0
+
+        bench_import(sizes, files, processes, repeat)
+
+    elif command == "decode":
+
+        if len(args) != 2:
+            usage(program_name)
+
+        bench_decode(args[1], repeat)
+
+    elif command == "corpus":
+
+        if len(args) < 2:
+            usage(program_name)
+
+        if use_rates:
+            rates = map(int, rates.split(","))
+        else:
+            rates = [44100, 48000]
+
+        if use_noise:
+            noise_levels = map(float, noise_levels.split(","))
+        else:
+            noise_levels = [0.0, 0.1]
+
+        if use_flutter:
+            flutters = map(float, flutters.split(","))
+        else:
+            flutters = [0.0, 0.5]
+
+        if use_dc:
+            offsets = map(float, offsets.split(","))
+        else:
+            offsets = [0.0, 0.2]
+
+        if use_decoders:
+            decoders = decoders.split(",")
+            for decoder in decoders:
+                if decoder not in ("record", "fft", "goertzel", "stft"):
+                    sys.stderr.write("Unknown decoder: %s\n" % decoder)
+                    sys.exit(1)
+        else:
+            decoders = ["record", "stft"]
+
+        import audioUEF
+
+        # Write the table of results to stderr if stdout is used for the
+        # JSON report.
+        if use_json and json_file == "-":
+            out = sys.stderr
+        else:
+            out = sys.stdout
+
+        results, timings = bench_corpus(args[1:], rates, noise_levels,
+                                        flutters, offsets, decoders, repeat,
+                                        out)
+
+        if use_json:
+            # The kernel is chosen when the filters are first used, which
+            # may only have happened in the worker processes.
+            kernel = audioUEF.filter_kernel or audioUEF.load_filter_kernel()
+            # The results of the decodings are kept apart from the timings,
+            # which vary from run to run, so that the results of two runs
+            # can be compared directly.
+            report = {"results": results,
+                      "timing": {"filter_kernel": kernel,
+                                 "repeat": repeat,
+                                 "runs": timings}}
+
+            if json_file == "-":
+                json_f = sys.stdout
+            else:
+                json_f = open(json_file, "w")
+
+            json.dump(report, json_f, indent = 2, sort_keys = True,
+                      separators = (",", ": "))
+            json_f.write("\n")
+
+            if json_f != sys.stdout:
+                json_f.close()
+
+    else:
+        usage(program_name)
@@ -19,9 +19,9 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import math, struct, sys
+import itertools, math, struct, sys
 import numpy as np
-import UEFfile
+import UEFfile, audioUEF
 
 def find_option(args, label, number = 0):
 
@@ -120,153 +120,474 @@ class Block(UEFfile.UEFfile):
 
 class Reader:
 
-    def __init__(self, format, step, sample_rate):
+    def __init__(self, format, step, sample_rate, detector = "fft", hop = None):
     
         self.format = format
         self.step = step
         self.sample_rate = sample_rate
         self.dt = 1.0/float(sample_rate)
+        self.detector = detector
+        
+        # The number of samples between the starts of overlapping frames
+        # used by the STFT detector
+        if hop is None:
+            hop = max(1, self.window_length()/4)
+        self.hop = hop
         
         self.threshold_1200 = 0.01
         self.threshold_2400 = 0.005
         
         self.T = 0
+        
+        # Samples kept from one buffer to the next by the sliding DFTs
+        self.tail = np.zeros(self.window_length() - 1)
+        
+        # An optional audioUEF.Progress object for reporting progress
+        self.progress = None
+        
+        # The start and end times of blocks that could not be read, with the
+        # reasons for the failures
+        self.failures = []
+        
+        # The number of windows of high tone after a byte that are taken to
+        # be the leader of a new block
+        self.leader_windows = 16
     
     def start_at(self, start_time):
     
         self.start_time = start_time
     
-    def V(self, V0, Vapp, R, C, dt):
+    def window_length(self):
     
-        # The current that flows is due to the potential difference between the
-        # applied potential and the potential at the capacitor. The resistor acts
-        # to moderate this flow.
-        i = (Vapp - V0)/R
-        # Change the charge at the capacitor by the new charge transported by the
-        # electric current.
-        q = (C * V0) + (i * dt)
-        # Calculate the voltage over the capacitor.
-        V1 = q / C
-        V1 = max(-1.0, min(V1, 1.0))
-        
-        return V1, i
+        # Each window holds a single cycle of a 1200 Hz tone.
+        return len(np.arange(0, 1.0/1200, self.dt))
     
-    def read_byte(self, audio_f):
+    def fft_frequencies(self, audio_f):
     
-        sign = None
-        t = 0
-        state = "waiting"
-        current = None
-        cycles = 0
-        data = []
-        bits = 0
-        shift = 0
+        """Yields the stronger of the 1200 Hz and 2400 Hz frequencies, or None
+        if neither is present, for each window of the audio using a full FFT.
+        """
         
         a = np.arange(0, 1.0/1200, self.dt)
         l = len(a)
-        f = np.linspace(0, self.sample_rate, l)
-        f1200 = np.where(f == 1200.0)[0][0]
-        f2400 = np.where(f == 2400.0)[0][0]
         
-        # Low-pass filter constants
-        resonant_f1 = 1200.0
-        R1 = 1000
-        C1 = 1.0/(2 * math.pi * resonant_f1 * R1)
+        # The bins nearest to each frequency
+        bin1200 = int(round(1200.0 * l * self.dt))
+        bin2400 = int(round(2400.0 * l * self.dt))
         
-        # High-pass filter constants
-        resonant_f2 = 1200.0
-        R2 = 1000
-        C2 = 1.0/(2 * math.pi * resonant_f2 * R2)
+        # The number of samples in one cycle of a 1200 Hz tone
+        cycle = self.sample_rate/1200.0
         
-        Vc1 = 0
-        Vc2 = 0
+        # Filtered samples left over from the previous buffer, and the
+        # position of the first of them
+        s1 = np.zeros(0)
+        first = 0
+        start_T = None
+        window = 0
         
-        s1 = np.zeros(l)
-        i = 0
+        # The last window is only complete if more samples follow it, so a
+        # window of silence is added at the end.
+        buffers = itertools.chain(self.filtered_samples(audio_f),
+                                  [np.zeros(l)])
         
-        while True:
+        for samples in buffers:
         
-            sample = audio_f.read(self.step)
-            if not sample:
-                raise StopIteration
+            if start_T is None:
+                start_T = self.T
+            
+            x = np.append(s1, samples)
+            end = first + len(x)
+            
+            # Each window starts a whole number of cycles after the first
+            # sample, rounded to the nearest sample, so that the windows do
+            # not drift away from the cycles in the signal when a cycle does
+            # not fit a whole number of samples.
+            start = int(round(window * cycle))
+            
+            while start + l <= end:
+            
+                ff1 = abs(np.fft.rfft(x[start - first:start - first + l]))
+                
+                # The time is that of the last sample in the window.
+                self.T = start_T + (start + l - 1) * self.dt
+                
+                # Convert the magnitudes to amplitudes to compare them with
+                # the threshold for silence.
+                m1200 = ff1[bin1200]
+                m2400 = ff1[bin2400]
+                if 2 * max(m1200, m2400)/l < self.threshold_1200:
+                    yield None
+                elif m2400 > m1200:
+                    yield 2400.0
+                else:
+                    yield 1200.0
+                
+                window += 1
+                start = int(round(window * cycle))
             
+            s1 = x[start - first:]
+            first = start
+            self.T = start_T + end * self.dt
+            
+            if self.progress:
+                self.progress.update(self.T)
+    
+    def filtered_samples(self, audio_f):
+    
+        """Yields arrays of filtered samples from the start time onwards,
+        setting the time to that of the first sample in each array."""
+        
+        a1 = 2 * math.pi * 1200.0 * self.dt
+        a2 = 2 * math.pi * 1200.0 * self.dt
+        Vc1 = 0.0
+        Vc2 = 0.0
+        
+        for values in audioUEF.read_samples(audio_f, self.format, self.step):
+        
             if self.T < self.start_time:
-                self.T += self.dt
-                continue
+                skip = min(len(values),
+                           int(math.ceil((self.start_time - self.T)/self.dt)))
+                self.T += skip * self.dt
+                values = values[skip:]
+                if len(values) == 0:
+                    continue
             
-            values = struct.unpack(format, sample)
-            value = values[0]
+            # Apply the low-pass filter, then the high-pass filter to its
+            # output, taking the output from the current that flows.
+            V1, V2 = audioUEF.rc_filters(values/16.0, Vc1, a1, Vc2, a2)
+            previous = np.append(Vc2, V2[:-1])
+            Vc1 = V1[-1]
+            Vc2 = V2[-1]
             
-            Vapp = value/16.0
-            # Apply the low-pass filter.
-            Vc1, i1 = self.V(Vc1, Vapp, R1, C1, self.dt)
-            # Apply the high-pass filter to the output of the low-pass filter.
-            Vc2, i2 = self.V(Vc2, Vc1, R2, C2, self.dt)
+            yield np.clip(V1 - previous, -1.0, 1.0)
+    
+    def sliding_energies(self, samples):
+    
+        """Returns arrays containing the energy of the 1200 Hz and 2400 Hz
+        components of the window of samples ending at each of the samples
+        given, using sliding DFTs. The last samples are kept to form the start
+        of the windows for the next call."""
+        
+        l = self.window_length()
+        x = np.append(self.tail, samples)
+        self.tail = x[-(l - 1):] if l > 1 else x[:0]
+        
+        k = np.arange(len(x))
+        energies = []
+        
+        for frequency in 1200.0, 2400.0:
+        
+            w = 2 * math.pi * frequency * self.dt
+            sums = np.zeros(len(x) + 1, dtype = np.complex128)
+            sums[1:] = np.cumsum(x * np.exp(-1j * w * k))
             
-            s1[i] = max(-1.0, min(i2 * R2, 1.0))
+            # The DFT term for each window is the difference between the sums
+            # at its ends.
+            ends = np.arange(len(x) - len(samples), len(x)) + 1
+            terms = sums[ends] - sums[np.maximum(ends - l, 0)]
+            energies.append(abs(terms)**2)
+        
+        return energies
+    
+    def energy_ratios(self, samples):
+    
+        """Returns arrays containing the fraction of the combined 1200 Hz and
+        2400 Hz energy that is found at 2400 Hz in the window ending at each
+        of the samples given, or 0.5 where there is no energy at either
+        frequency, and the amplitude of the stronger frequency in each window.
+        """
+        
+        e1200, e2400 = self.sliding_energies(samples)
+        total = e1200 + e2400
+        ratios = np.empty(len(total))
+        ratios.fill(0.5)
+        nonzero = total > 0
+        ratios[nonzero] = e2400[nonzero]/total[nonzero]
+        
+        # Convert the energies to amplitudes to compare them with the
+        # threshold for silence.
+        amplitudes = 2 * np.sqrt(np.maximum(e1200, e2400))/self.window_length()
+        return ratios, amplitudes
+    
+    def goertzel_frequencies(self, audio_f):
+    
+        """Yields the stronger of the 1200 Hz and 2400 Hz frequencies, or None
+        if neither is present, for each window of the audio, using sliding
+        DFTs calculated over whole buffers of samples.
+        
+        Each sample is classified using the energy ratio of the window ending
+        at it. Runs of samples with the same classification are converted to
+        the number of 1200 Hz cycles they span, so that the windows follow
+        the changes in the signal instead of being a fixed number of samples
+        apart. Runs shorter than half a cycle are treated as part of the run
+        before them.
+        """
+        
+        self.tail = np.zeros(self.window_length() - 1)
+        
+        # The number of samples in one cycle of a 1200 Hz tone
+        cycle = self.sample_rate/1200.0
+        
+        frequencies = {0: None, 1: 1200.0, 2: 2400.0}
+        
+        # The run of samples being emitted and the run that follows it
+        run_value = 0
+        run_length = 0
+        next_value = 0
+        next_length = 0
+        
+        start_T = None
+        position = 0
+        
+        # The decisions lag behind the signal by up to a window, so a window
+        # of silence is added at the end to complete the last run.
+        buffers = itertools.chain(self.filtered_samples(audio_f),
+                                  [np.zeros(self.window_length())])
+        
+        for samples in buffers:
+        
+            if start_T is None:
+                start_T = self.T
             
-            i += 1
+            ratios, amplitudes = self.energy_ratios(samples)
             
-            if i == l:
+            # Encode the decision for each sample: 0 for neither frequency,
+            # 1 for 1200 Hz and 2 for 2400 Hz.
+            decisions = np.where(amplitudes >= self.threshold_1200,
+                                 np.where(ratios > 0.5, 2, 1), 0)
             
-                i = 0
-                ff1 = abs(np.fft.fft(s1, l))/self.sample_rate
-                
-                m1 = max(ff1)
-                index = np.where(ff1 == m1)[0][0]
-                max_f1 = f[index]
-                #sys.stdout.write("\r%f %1.4f %1.4f" % (self.T, ff[f1200], ff[f2400]))
-                #sys.stdout.flush()
+            # Find the runs of samples with the same decision.
+            changes = np.flatnonzero(decisions[1:] != decisions[:-1]) + 1
+            run_starts = np.append(0, changes)
+            run_ends = np.append(changes, len(decisions))
+            
+            for j in xrange(len(run_starts)):
+            
+                value = decisions[run_starts[j]]
+                length = run_ends[j] - run_starts[j]
                 
-                if state == "data":
-                    print self.T, max_f1
+                if value == next_value:
+                    next_length += length
+                    continue
                 
-                if max_f1 == 2400.0:
-                    current = "high"
-                elif max_f1 == 1200.0:
-                    current = "low"
-                elif current == "low":
-                    current = "high"
+                # The next run is complete.
+                if next_length < cycle/2 or next_value == run_value:
+                    run_length += next_length
                 else:
-                    current = "low"
+                    # Emit the current run as the number of cycles it spans,
+                    # at the time of its last sample.
+                    end = position + run_starts[j] - next_length - 1
+                    self.T = start_T + end * self.dt
+                    for i in xrange(int(round(run_length/cycle))):
+                        yield frequencies[run_value]
+                    
+                    run_value = next_value
+                    run_length = next_length
                 
-                if current == "high":
+                next_value = value
+                next_length = length
+            
+            position += len(samples)
+            self.T = start_T + position * self.dt
+            
+            if self.progress:
+                self.progress.update(self.T)
+        
+        if next_length < cycle/2 or next_value == run_value:
+            run_length += next_length
+        else:
+            for i in xrange(int(round(run_length/cycle))):
+                yield frequencies[run_value]
+            run_value = next_value
+            run_length = next_length
+        
+        for i in xrange(int(round(run_length/cycle))):
+            yield frequencies[run_value]
+    
+    def stft_frequencies(self, audio_f):
+    
+        """Yields the stronger of the 1200 Hz and 2400 Hz frequencies, or None
+        if neither is present, for each window of the audio, using the FFTs of
+        overlapping frames.
+        
+        Each buffer of samples is divided into frames of one window length
+        that start a hop apart, and the FFTs of all the frames are calculated
+        at once. Runs of frames with the same frequency are converted back to
+        the number of 1200 Hz cycles they span, so that the boundaries between
+        runs fall at the resolution of the hop rather than of the window.
+        """
+        
+        l = self.window_length()
+        hop = self.hop
+        
+        # The bins nearest to each frequency
+        bin1200 = int(round(1200.0 * l * self.dt))
+        bin2400 = int(round(2400.0 * l * self.dt))
+        
+        # The number of samples in one cycle of a 1200 Hz tone
+        cycle = self.sample_rate/1200.0
+        
+        frequencies = {0: None, 1: 1200.0, 2: 2400.0}
+        
+        tail = np.zeros(0)
+        tail_T = None
+        
+        run_value = None
+        run_frames = 0
+        
+        # The frames at the end of the audio are only complete if more
+        # samples follow them, so a window of silence is added at the end.
+        buffers = itertools.chain(self.filtered_samples(audio_f),
+                                  [np.zeros(l)])
+        
+        for samples in buffers:
+        
+            if tail_T is None:
+                tail_T = self.T
+            
+            x = np.append(tail, samples)
+            
+            if len(x) < l:
+                tail = x
+                continue
+            
+            frame_count = (len(x) - l)/hop + 1
+            x = np.ascontiguousarray(x)
+            frames = np.lib.stride_tricks.as_strided(x,
+                shape = (frame_count, l),
+                strides = (hop * x.strides[0], x.strides[0]))
+            
+            spectra = abs(np.fft.rfft(frames, axis = 1))
+            
+            # Convert the magnitudes to amplitudes to compare them with the
+            # threshold for silence.
+            m1200 = spectra[:, bin1200]
+            m2400 = spectra[:, bin2400]
+            high = m2400 > m1200
+            present = 2 * np.maximum(m1200, m2400)/l >= self.threshold_1200
+            
+            # Encode the decision for each frame: 0 for neither frequency,
+            # 1 for 1200 Hz and 2 for 2400 Hz.
+            decisions = np.where(present, np.where(high, 2, 1), 0)
+            
+            # Find the runs of frames with the same decision.
+            changes = np.flatnonzero(decisions[1:] != decisions[:-1]) + 1
+            run_starts = np.append(0, changes)
+            run_ends = np.append(changes, frame_count)
+            
+            for j in xrange(len(run_starts)):
+            
+                value = decisions[run_starts[j]]
+                length = run_ends[j] - run_starts[j]
                 
-                    if state == "waiting":
-                        state = "ready"
-                        #print self.T, state
-                    
-                    elif state == "after":
-                        state = "ready"
-                        #print self.T, state
-                        yield bits
-                    
-                    elif state == "data":
-                        bits = (bits >> 1) | 0x80
-                        shift += 1
-                        #print "1", self.T, hex(bits)
-                        #print "1",
+                if value == run_value:
+                    run_frames += length
+                    continue
                 
-                elif current == "low":
+                # Emit the previous run as the number of cycles it spans, at
+                # the time of the end of its last frame.
+                self.T = tail_T + ((run_starts[j] - 1) * hop + l - 1) * self.dt
+                for i in xrange(int(round(run_frames * hop / cycle))):
+                    yield frequencies[run_value]
                 
-                    if state == "data":
-                        bits = bits >> 1
-                        shift += 1
-                        #print "0", self.T, hex(bits)
-                        #print "0",
-                    
-                    elif state == "ready":
-                        state = "data"
-                        #print self.T, state
-                        bits = 0
-                        shift = 0
+                run_value = value
+                run_frames = length
+            
+            tail = x[frame_count * hop:]
+            tail_T = tail_T + frame_count * hop * self.dt
+            
+            if self.progress:
+                self.progress.update(tail_T)
+        
+        for i in xrange(int(round(run_frames * hop / cycle))):
+            yield frequencies[run_value]
+    
+    def read_byte(self, audio_f):
+    
+        state = "waiting"
+        current = None
+        bits = 0
+        shift = 0
+        
+        # The number of windows of high tone since the last byte. Bytes in a
+        # block follow each other directly, so a longer run of high tone is
+        # the leader of another block.
+        tone = 0
+        
+        if self.detector == "goertzel":
+            frequencies = self.goertzel_frequencies(audio_f)
+        elif self.detector == "stft":
+            frequencies = self.stft_frequencies(audio_f)
+        else:
+            frequencies = self.fft_frequencies(audio_f)
+        
+        for max_f1 in frequencies:
+        
+            if state == "data":
+                print self.T, max_f1
+            
+            if max_f1 == 2400.0:
+                current = "high"
+            elif max_f1 == 1200.0:
+                current = "low"
+            elif current == "low":
+                current = "high"
+            else:
+                current = "low"
+            
+            if current == "high":
+            
+                if state == "waiting":
+                    state = "ready"
+                    tone = 0
+                    #print self.T, state
+                
+                elif state == "after":
+                    state = "ready"
+                    tone = 0
+                    #print self.T, state
+                    yield bits
                 
-                if shift == 8:
-                    print hex(bits)
-                    state = "after"
+                elif state == "ready":
+                    tone += 1
+                    if tone == self.leader_windows:
+                        # Tell the block reader that synchronisation was lost.
+                        yield None
+                
+                elif state == "data":
+                    bits = (bits >> 1) | 0x80
+                    shift += 1
+                    #print "1", self.T, hex(bits)
+                    #print "1",
+            
+            elif current == "low":
+            
+                if state == "data":
+                    bits = bits >> 1
+                    shift += 1
+                    #print "0", self.T, hex(bits)
+                    #print "0",
+                
+                elif state == "ready":
+                    state = "data"
+                    #print self.T, state
+                    bits = 0
                     shift = 0
             
-            self.T += self.dt
+            if shift == 8:
+                print hex(bits)
+                state = "after"
+                shift = 0
+    
+    def checked_bytes(self, gen):
+    
+        """Passes on the bytes from the generator given, stopping with an
+        exception if synchronisation with the signal is lost."""
+        
+        for byte in gen:
+            if byte is None:
+                raise ValueError("Lost synchronisation at %.3f seconds." % self.T)
+            yield byte
     
     def read_block(self, audio_f):
     
@@ -276,11 +597,14 @@ class Reader:
             byte = gen.next()
             
             if byte == 0x2a:
+                start = self.T
                 try:
                     print ">", self.T
-                    yield Block(gen)
-                except ValueError:
-                    raise
+                    yield Block(self.checked_bytes(gen))
+                except ValueError, exc:
+                    # Noise can be decoded as the start of a block, so keep
+                    # looking for blocks after one that cannot be read.
+                    self.failures.append((start, self.T, str(exc)))
 
 
 if __name__ == "__main__":
@@ -292,18 +616,70 @@ if __name__ == "__main__":
     unsigned = find_option(args, "--unsigned", 0)
     s, sample_size = find_option(args, "--size", 1)
     start, start_time = find_option(args, "--start", 1)
+    quiet = find_option(args, "--quiet", 0)
+    goertzel = find_option(args, "--goertzel", 0)
+    stft, hop = find_option(args, "--stft", 1)
     
-    if len(args) != 2 or not s or not r:
-        sys.stderr.write("Usage: %s [--rate <sample rate in Hz>] [--mono] [--unsigned] [--size <sample size in bits>] [--start <time in seconds>] <audio file> <UEF file>\n" % program_name)
+    usage = "Usage: %s [--rate <sample rate in Hz>] [--mono] [--unsigned] [--size <sample size in bits>] [--start <time in seconds>] [--quiet] [--goertzel | --stft <hop in samples>] <audio file> <UEF file>\n" % program_name
+    
+    if len(args) != 2:
+        sys.stderr.write(usage)
         sys.exit(1)
     
     audio_file = args[0]
     uef_file = args[1]
+    wav = None
+    stream = None
     
     if audio_file == "-":
-        audio_f = sys.stdin
+        # Read standard input through a buffer of fixed size, reading the
+        # header first if it contains a WAV file.
+        audio_f = stream = audioUEF.AudioStream(sys.stdin)
+        header = stream.read(4)
+        stream.unread(header)
+        
+        if header == "RIFF":
+            try:
+                stream.read_wav_header()
+            except IOError, exc:
+                sys.stderr.write(str(exc) + "\n")
+                sys.exit(1)
+            
+            mono = True
+            if not r:
+                sample_rate = stream.sample_rate
+            if stream.sample_size == 8 and not stream.floating:
+                sample_size = 8
+            else:
+                sample_size = 16
+            s = r = True
     else:
         audio_f = open(audio_file, "rb")
+        
+        if audio_f.read(4) == "RIFF":
+            # Read WAV files through a memory map, converting the samples to
+            # the range of 8 or 16-bit signed values.
+            audio_f.close()
+            try:
+                audio_f = wav = audioUEF.WavFile(audio_file)
+            except IOError, exc:
+                sys.stderr.write(str(exc) + "\n")
+                sys.exit(1)
+            
+            mono = True
+            if not r:
+                sample_rate = wav.sample_rate
+            if wav.sample_size == 8 and not wav.floating:
+                sample_size = 8
+            else:
+                sample_size = 16
+            s = r = True
+        else:
+            audio_f.seek(0, 0)
+    
+    if not s or not r:
+        sys.stderr.write(usage)
+        sys.exit(1)
     
     try:
         sample_size = int(sample_size)
@@ -328,9 +704,38 @@ if __name__ == "__main__":
         format = format * 2
     
     format = "<" + format
-    reader = Reader(format, step, float(sample_rate))
+    
+    if stream and stream.buffer is None:
+        stream.set_raw_format(format, step)
+    
+    if goertzel:
+        detector = "goertzel"
+    elif stft:
+        detector = "stft"
+    else:
+        detector = "fft"
+    
+    if stft:
+        hop = int(hop)
+    else:
+        hop = None
+    
+    reader = Reader(format, step, float(sample_rate), detector, hop)
     reader.start_at(float(start_time))
     
+    if wav:
+        # Seek directly to the start of the audio to be read.
+        frame = int(float(start_time) * float(sample_rate))
+        wav.seek(frame)
+        reader.T = frame * reader.dt
+    elif stream:
+        # Read and discard the audio before the start time.
+        frame = int(float(start_time) * float(sample_rate))
+        reader.T = stream.skip(frame) * reader.dt
+    
+    if not quiet:
+        reader.progress = audioUEF.Progress()
+    
     last_T = 0
     data = []
     blocks = []
@@ -348,6 +753,13 @@ if __name__ == "__main__":
     else:
         for block in reader.read_block(audio_f):
             print block.name, hex(block.load_addr), hex(block.exec_addr), block.number, block.length
+            sys.stdout.flush()
             blocks.append(block)
     
+    if reader.progress:
+        reader.progress.finish()
+    
+    for start, end, message in reader.failures:
+        sys.stderr.write("%s (%.3f to %.3f seconds)\n" % (message, start, end))
+    
     #sys.exit()
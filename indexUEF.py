@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+
+"""
+indexUEF.py - Index the files stored in collections of UEF archives.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib, multiprocessing, os, shutil, sqlite3, sys
+import UEFfile
+
+version = "0.1"
+
+schema = """
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    mtime REAL,
+    size INTEGER,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    archive INTEGER,
+    position INTEGER,
+    name TEXT COLLATE NOCASE,
+    load INTEGER,
+    exec INTEGER,
+    length INTEGER,
+    hash TEXT
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    archive INTEGER,
+    id INTEGER,
+    count INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_archive ON files (archive);
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+CREATE INDEX IF NOT EXISTS files_load ON files (load);
+CREATE INDEX IF NOT EXISTS files_exec ON files (exec);
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+CREATE INDEX IF NOT EXISTS chunks_archive ON chunks (archive);
+CREATE INDEX IF NOT EXISTS chunks_id ON chunks (id);
+"""
+
+def find_option(args, label, number = 0):
+
+    """Matches an option in a list of command line arguments, returning a
+    single boolean value for options without arguments and a tuple for options
+    with arguments.
+
+    For options with arguments, the tuple contains a boolean value and a list
+    of arguments found unless only one argument is expected, in which case the
+    value itself is included in the tuple instead of a list.
+
+    If the boolean value is True, the option was found. If it is False then
+    either it was not found or the required number of arguments was not found.
+    """
+
+    try:
+        i = args.index(label)
+    except ValueError:
+        if number == 0:
+            return False
+        else:
+            return False, None
+
+    values = args[i + 1:i + number + 1]
+    args[:] = args[:i] + args[i + number + 1:]
+
+    if number == 0:
+        return True
+
+    if len(values) < number:
+        return False, values
+
+    if number == 1:
+        values = values[0]
+
+    return True, values
+
+
+def data_hash(data):
+
+    """Returns the hash used to identify the contents of a file."""
+
+    return hashlib.sha1(data).hexdigest()
+
+
+def open_index(index_file):
+
+    """Opens the index database with the given file name, creating the tables
+    it uses if they do not already exist."""
+
+    db = sqlite3.connect(index_file)
+
+    # File names in UEF archives are byte strings which may contain
+    # characters outside the ASCII range.
+    db.text_factory = str
+    db.executescript(schema)
+    return db
+
+
+def find_archives(directory):
+
+    """Returns a list of the paths of the UEF archives found in the directory
+    tree starting at the directory given."""
+
+    paths = []
+
+    for dirpath, dirnames, filenames in os.walk(directory):
+
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(UEFfile.suffix + "uef"):
+                paths.append(os.path.join(dirpath, filename))
+
+    return paths
+
+
+def store_path(store, hash):
+
+    """Returns the path of the file in the content-addressed store that holds
+    the data with the given hash."""
+
+    return os.path.join(store, hash[:2], hash)
+
+
+def store_data(store, hash, data):
+
+    """Writes the data with the given hash to the content-addressed store
+    unless the store already contains it. Data is written to a temporary file
+    first and renamed so that other processes never see incomplete files."""
+
+    path = store_path(store, hash)
+    if os.path.exists(path):
+        return
+
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+
+    temp_path = "%s.%i.tmp" % (path, os.getpid())
+    f = open(temp_path, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+    os.rename(temp_path, path)
+
+
+def scan_archive(path, store = None):
+
+    """Reads the UEF archive with the given path, returning a tuple containing
+    the path, a list of the files it contains, a dictionary mapping chunk
+    numbers to the number of chunks of each type, and a description of any
+    error encountered.
+
+    Each file is described by a tuple containing its position in the archive,
+    name, load and execution addresses, length and data hash. If a store
+    directory is given then the data of each file is also written to the
+    content-addressed store in that directory."""
+
+    try:
+        u = UEFfile.UEFfile(path)
+    except Exception, exc:
+        return path, [], {}, str(exc) or exc.__class__.__name__
+
+    positions = range(len(u.contents))
+    info = u.export_files(positions)
+    if len(positions) == 1:
+        info = [info]
+
+    files = []
+    for position, (name, load, exe, data) in zip(positions, info):
+
+        hash = data_hash(data)
+        files.append((position, name, load, exe, len(data), hash))
+
+        if store:
+            store_data(store, hash, data)
+
+    histogram = {}
+    for chunk_id, chunk_data in u.chunks:
+        histogram[chunk_id] = histogram.get(chunk_id, 0) + 1
+
+    return path, files, histogram, None
+
+
+def scan_task(args):
+
+    return scan_archive(*args)
+
+
+def in_store(db, store, archive_id):
+
+    """Returns True if the data of every file in the archive with the given
+    identifier is present in the content-addressed store."""
+
+    for (hash,) in db.execute("SELECT hash FROM files WHERE archive = ?",
+                              (archive_id,)):
+        if not os.path.exists(store_path(store, hash)):
+            return False
+
+    return True
+
+
+def build_index(db, directory, jobs = None, store = None):
+
+    """Scans the UEF archives in the directory tree given using a pool of
+    processes and records their details in the index database. Archives that
+    are unchanged since the last time they were indexed are not read again,
+    and archives that no longer exist are removed from the index.
+
+    If a store directory is given then the data of each file is written to a
+    content-addressed store in that directory, with each unique file stored
+    only once. Unchanged archives are read again if any of their files are
+    missing from the store.
+
+    Returns the number of archives that were read."""
+
+    directory = os.path.abspath(directory)
+    known = {}
+    for archive_id, path, mtime, size in db.execute(
+        "SELECT id, path, mtime, size FROM archives"):
+        known[path] = (archive_id, mtime, size)
+
+    found = set()
+    stats = {}
+    pending = []
+
+    for path in find_archives(directory):
+
+        found.add(path)
+        st = os.stat(path)
+        stats[path] = (st.st_mtime, st.st_size)
+
+        if path in known and known[path][1:] == stats[path]:
+            if not store or in_store(db, store, known[path][0]):
+                continue
+
+        pending.append((path, store))
+
+    # Forget about archives that have been removed from the tree.
+    prefix = directory.rstrip(os.sep) + os.sep
+    for path, (archive_id, mtime, size) in known.items():
+        if path.startswith(prefix) and path not in found:
+            remove_archive(db, archive_id)
+
+    if not pending:
+        db.commit()
+        return 0
+
+    pool = multiprocessing.Pool(jobs)
+
+    try:
+        for path, files, histogram, error in pool.imap_unordered(
+            scan_task, pending, 16):
+
+            if path in known:
+                remove_archive(db, known[path][0])
+
+            mtime, size = stats[path]
+            cursor = db.execute(
+                "INSERT INTO archives (path, mtime, size, error) "
+                "VALUES (?, ?, ?, ?)", (path, mtime, size, error))
+            archive_id = cursor.lastrowid
+
+            db.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(archive_id,) + details for details in files])
+            db.executemany(
+                "INSERT INTO chunks VALUES (?, ?, ?)",
+                [(archive_id, chunk_id, count)
+                 for chunk_id, count in histogram.items()])
+
+            if error:
+                sys.stderr.write("%s: %s\n" % (path, error))
+    finally:
+        pool.close()
+        pool.join()
+        db.commit()
+
+    return len(pending)
+
+
+def remove_archive(db, archive_id):
+
+    """Removes all records of the archive with the given identifier from the
+    index database."""
+
+    db.execute("DELETE FROM files WHERE archive = ?", (archive_id,))
+    db.execute("DELETE FROM chunks WHERE archive = ?", (archive_id,))
+    db.execute("DELETE FROM archives WHERE id = ?", (archive_id,))
+
+
+def query_index(db, name = None, load = None, exec_addr = None,
+                length = None, hash = None, chunk_id = None):
+
+    """Returns a list of tuples describing the files in the index that match
+    all of the criteria given. Each tuple contains the path of the archive
+    holding the file, its position in the archive, name, load and execution
+    addresses, length and data hash.
+
+    Names are matched without regard to case, and may contain the * and ?
+    wildcard characters. If chunk_id is given then only files in archives
+    containing at least one chunk of that type are returned."""
+
+    conditions = []
+    values = []
+
+    if name is not None:
+        conditions.append("files.name LIKE ? ESCAPE '\\'")
+        pattern = name.replace("\\", "\\\\").replace("%", "\\%")
+        pattern = pattern.replace("_", "\\_")
+        values.append(pattern.replace("*", "%").replace("?", "_"))
+
+    for column, value in (("load", load), ("exec", exec_addr),
+                          ("length", length), ("hash", hash)):
+        if value is not None:
+            conditions.append("files.%s = ?" % column)
+            values.append(value)
+
+    if chunk_id is not None:
+        conditions.append("files.archive IN "
+                          "(SELECT archive FROM chunks WHERE id = ?)")
+        values.append(chunk_id)
+
+    sql = ("SELECT archives.path, files.position, files.name, files.load, "
+           "files.exec, files.length, files.hash "
+           "FROM files JOIN archives ON files.archive = archives.id")
+
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+
+    sql += " ORDER BY archives.path, files.position"
+
+    return db.execute(sql, values).fetchall()
+
+
+def extract_files(store, out_path, matches):
+
+    """Writes the files described by the list of matches returned by the
+    query_index function to subdirectories of the output path, one for each
+    archive, using the data held in the content-addressed store. An .inf file
+    is written for each file.
+
+    The data is copied so that the extracted files can be edited without
+    changing the store."""
+
+    directories = {}
+    u = UEFfile.UEFfile()
+
+    for path, position, name, load, exe, length, hash in matches:
+
+        if path not in directories:
+
+            leafname = os.path.splitext(os.path.basename(path))[0]
+            directory = os.path.join(out_path, leafname)
+            n = 2
+            while directory in directories.values():
+                directory = os.path.join(out_path, "%s-%i" % (leafname, n))
+                n += 1
+
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            directories[path] = directory
+
+        directory = directories[path]
+        write_name = u.printable(name).replace(os.sep, "-")
+        file_path = os.path.join(directory, write_name)
+        if os.path.exists(file_path):
+            file_path = os.path.join(directory, "%s-%i" % (write_name, position))
+
+        source = store_path(store, hash)
+        if not os.path.exists(source):
+            sys.stderr.write("Data for file %i of %s is not in the store.\n" % (
+                position, path))
+            continue
+
+        # Replace any file left by an earlier extraction instead of writing
+        # through it, since it may be a link to the store.
+        if os.path.lexists(file_path):
+            os.remove(file_path)
+        shutil.copyfile(source, file_path)
+
+        inf_file = open(file_path + UEFfile.suffix + "inf", "w")
+        inf_file.write("$.%s\t%x\t%x\t%x\n" % (name, load, exe, length))
+        inf_file.close()
+
+
+def query_options(args):
+
+    """Removes the options used to specify query criteria from the list of
+    command line arguments given and returns a dictionary of keyword
+    arguments for the query_index function."""
+
+    use_name, name = find_option(args, "--name", 1)
+    use_load, load = find_option(args, "--load", 1)
+    use_exec, exec_addr = find_option(args, "--exec", 1)
+    use_length, length = find_option(args, "--length", 1)
+    use_hash, hash = find_option(args, "--hash", 1)
+    use_chunk, chunk_id = find_option(args, "--chunk", 1)
+
+    try:
+        if use_load:
+            load = int(load, 16)
+        if use_exec:
+            exec_addr = int(exec_addr, 16)
+        if use_length:
+            length = int(length, 16)
+        if use_chunk:
+            chunk_id = int(chunk_id, 16)
+    except ValueError:
+        sys.stderr.write("Addresses, lengths and chunk numbers must be "
+                         "given in hexadecimal.\n")
+        sys.exit(1)
+
+    if use_hash:
+        hash = hash.lower()
+
+    return {"name": name, "load": load, "exec_addr": exec_addr,
+            "length": length, "hash": hash, "chunk_id": chunk_id}
+
+
+def usage(program_name):
+
+    sys.stderr.write(
+        "Usage: %s <index file> build [--jobs <processes>] "
+        "[--store <directory>] <directory> ...\n"
+        "       %s <index file> query [--name <name>] [--load <address>] "
+        "[--exec <address>] [--length <length>] [--hash <hash>] "
+        "[--chunk <chunk number>]\n"
+        "       %s <index file> extract <store directory> <directory> "
+        "[query options]\n" % (program_name, program_name, program_name))
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    program_name, args = sys.argv[0], sys.argv[1:]
+
+    if len(args) < 2:
+        usage(program_name)
+
+    index_file, command, args = args[0], args[1], args[2:]
+
+    if command == "build":
+
+        use_jobs, jobs = find_option(args, "--jobs", 1)
+        use_store, store = find_option(args, "--store", 1)
+
+        if not args:
+            usage(program_name)
+
+        if use_jobs:
+            jobs = int(jobs)
+        else:
+            jobs = None
+
+        if use_store:
+            store = os.path.abspath(store)
+
+        db = open_index(index_file)
+        for directory in args:
+            print "Indexed %i archives in %s" % (
+                build_index(db, directory, jobs, store), directory)
+        db.close()
+
+    elif command == "query":
+
+        criteria = query_options(args)
+
+        if args:
+            usage(program_name)
+
+        db = open_index(index_file)
+        u = UEFfile.UEFfile()
+
+        for path, position, name, load, exec_addr, length, hash in \
+            query_index(db, **criteria):
+
+            print "%s: %i %s %x %x %x %s" % (path, position,
+                u.printable(name), load, exec_addr, length, hash)
+
+        db.close()
+
+    elif command == "extract":
+
+        criteria = query_options(args)
+
+        if len(args) != 2:
+            usage(program_name)
+
+        store, out_path = args
+
+        db = open_index(index_file)
+        extract_files(store, out_path, query_index(db, **criteria))
+        db.close()
+
+    else:
+        usage(program_name)
@@ -0,0 +1,55 @@
+/*
+rcfilter.c - Compiled filter kernel for audioUEF.py.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Build the library in the same directory as audioUEF.py with
+
+  python setup.py build_kernel
+
+and it will be loaded using ctypes if Numba is not available. Without
+either of them, audioUEF filters the samples with NumPy instead.
+*/
+
+/* Applies two clamped RC filters to the n values given, the second to the
+   output of the first, starting from voltages of V1 and V2 over their
+   capacitors. The voltages after each value are written to out1 and out2.
+   The arithmetic is the same as the pure Python version in audioUEF.py. */
+
+void rc_filters(const double *values, long n, double V1, double a1,
+                double V2, double a2, double lower, double upper,
+                double *out1, double *out2)
+{
+    double b1 = 1.0 - a1;
+    double b2 = 1.0 - a2;
+    long i;
+
+    for (i = 0; i < n; i++) {
+
+        V1 = b1 * V1 + a1 * values[i];
+        if (V1 < lower)
+            V1 = lower;
+        else if (V1 > upper)
+            V1 = upper;
+
+        V2 = b2 * V2 + a2 * V1;
+        if (V2 < lower)
+            V2 = lower;
+        else if (V2 > upper)
+            V2 = upper;
+
+        out1[i] = V1;
+        out2[i] = V2;
+    }
+}
@@ -19,8 +19,9 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import math, struct, sys
-import UEFfile
+import math, multiprocessing, struct, sys
+import numpy as np
+import UEFfile, audioUEF
 
 version = "0.1"
 
@@ -183,8 +184,23 @@ class Reader:
         self.zero_count = self.sample_rate/zero_count
         
         self.dt = 1.0/sample_rate
+        self.width_tolerance = 0.001 * self.dt
         self.T = 0
         self.stop_time = None
+        
+        # In resilient mode, blocks that cannot be read are recorded as
+        # (start time, end time, message) tuples instead of stopping the
+        # decoding.
+        self.resilient = False
+        self.failures = []
+        self.failure_gap = 0.5
+        
+        # Progress is reported on stderr unless a quiet or debugging run is
+        # requested. Library users can replace this with their own reporter.
+        if quiet or debug:
+            self.progress = None
+        else:
+            self.progress = audioUEF.Progress(format = hms)
     
     def start_at(self, start_time):
     
@@ -195,24 +211,11 @@ class Reader:
     
         self.stop_time = stop_time
     
-    def V(self, V0, Vapp, R, C, dt):
-    
-        # The current that flows is due to the potential difference between the
-        # applied potential and the potential at the capacitor. The resistor acts
-        # to moderate this flow.
-        i = (Vapp - V0)/R
-        # Change the charge at the capacitor by the new charge transported by the
-        # electric current.
-        q = (C * V0) + (i * dt)
-        # Calculate the voltage over the capacitor.
-        V1 = q / C
-        V1 = max(-1.0, min(V1, 1.0))
-        
-        return V1, i
-    
     def process_pulse(self, tc, width):
     
-        if width >= self.width_1200:
+        # Pulse widths are whole numbers of sample periods, so allow for
+        # rounding errors when comparing them with the thresholds.
+        if width >= self.width_1200 - self.width_tolerance:
         
             self.current = "low"
             #print >>sys.stderr, "_"
@@ -241,7 +244,7 @@ class Reader:
             
             self.cycles = 0
         
-        elif width >= self.width_2400 or (self.ymax > 0 and 2000 <= 1/(tc - self.last_tc) <= 3000):
+        elif width >= self.width_2400 - self.width_tolerance or (self.ymax > 0 and 2000 <= 1/(tc - self.last_tc) <= 3000):
         
             # The pulse was large enough to be a 1 pulse, or one occurred close
             # enough to where one might be expected.
@@ -293,166 +296,207 @@ class Reader:
             self.cycles = 0
             return self.bits
     
+    def despike(self, values):
+    
+        """Returns the values given with isolated spikes removed. The values
+        returned are delayed by three samples, with the last three values
+        kept for the next call."""
+        
+        buf = self.spike_buf
+        output = []
+        
+        for value in values:
+        
+            buf.append(value)
+            
+            if len(buf) < 4:
+                continue
+            
+            # Check for a point that crosses the zero line out of sequence.
+            if buf[0] * buf[1] < 0 and buf[0] * buf[2] > 0:
+            
+                # Check for another crossing.
+                if buf[1] * buf[3] > 0:
+                    # Interpolate the two middle points.
+                    if self.debug:
+                        print >>sys.stderr, " double spike at", hms(self.T), buf[0], buf[1], buf[2], buf[3], "->", (buf[1] + buf[3])/2.0
+                    buf[1] = ((2 * buf[0]) + buf[3])/3.0
+                    buf[2] = (buf[0] + (2 * buf[3]))/3.0
+                else:
+                    # Interpolate the second point.
+                    if self.debug:
+                        print >>sys.stderr, " single spike at", hms(self.T), buf[0], buf[1], buf[2], buf[3], "->", (buf[0] + buf[2])/2.0
+                    buf[1] = (buf[0] + buf[2])/2.0
+            
+            else:
+                b0 = buf[1] - buf[0]
+                b1 = buf[2] - buf[1]
+                b2 = buf[3] - buf[2]
+                if b0 * b1 < 0 and b0 * b2 > 0:
+                
+                    # Interpolate the second point.
+                    if self.debug:
+                        print >>sys.stderr, " smoothing", hms(self.T), buf[0], buf[1], buf[2], buf[3], "->", (buf[0] + buf[2])/2.0
+                    buf[2] = (buf[1] + buf[3])/2.0
+            
+            output.append(buf.pop(0))
+        
+        return np.array(output)
+    
+    def filter(self, values):
+    
+        """Applies the filters to the values given, starting from the current
+        state of the filters, and returns arrays containing the output of the
+        filters and their states after each value."""
+        
+        mean_count = self.sample_rate/3900
+        means = audioUEF.scan(float(mean_count - 1)/mean_count,
+                              values/float(mean_count), self.mean)
+        
+        Vapp = (values - means) * self.boost_factor/8.0
+        
+        # Apply the low-pass filter, then the high-pass filter to the output
+        # of the low-pass filter.
+        Vc1, Vc2 = audioUEF.rc_filters(Vapp, self.Vc1,
+                                       2 * math.pi * self.f1 * self.dt,
+                                       self.Vc2,
+                                       2 * math.pi * self.f2 * self.dt)
+        
+        # The output is the current through the resistor of the high-pass
+        # filter, which depends on the previous voltage over its capacitor.
+        previous = np.empty(len(Vc2))
+        previous[0] = self.Vc2
+        previous[1:] = Vc2[:-1]
+        
+        y = np.clip(Vc1 - previous, 0.0, 1.0)
+        
+        return y, means, Vc1, Vc2
+    
     def read_byte(self, audio_f):
     
-        sign = None
         self.state = "waiting"
         self.current = None
-        data = []
         self.bits = 0
         self.shift = 0
         self.cycles = 0
         self.ymax = 0
         
-        # Low-pass filter constants
-        resonant_f1 = self.f1
-        R1 = 1000
-        C1 = 1.0/(2 * math.pi * resonant_f1 * R1)
-        
-        # High-pass filter constants
-        resonant_f2 = self.f2
-        R2 = 1000
-        C2 = 1.0/(2 * math.pi * resonant_f2 * R2)
-        
-        Vc1 = 0
-        Vc2 = 0
-        
-        dt = self.dt
-        old_y = 0
-        y = 0
-        dy = 0
+        # Filter state
+        self.mean = 0.0
+        self.Vc1 = 0.0
+        self.Vc2 = 0.0
+        self.spike_buf = []
         
-        previous = None
         tc = 0
         self.last_tc = 0
-        mean = 0.0
         
-        start_t = None
-        end_t = None
-        
-        floor_count = 0
-        zero_count = self.zero_count
-        mean_count = self.sample_rate/3900
+        finder = audioUEF.PulseFinder(self.zero_count)
         
         if self.debug:
             f = open("/tmp/debug.s8", "wb")
         
-        if self.filter_:
-            buf = []
-        
-        while True:
+        for values in audioUEF.read_samples(audio_f, self.format, self.step):
         
-            sample = audio_f.read(self.step)
-            if not sample:
-                raise StopIteration
-            
-            if self.stop_time != None and self.T > self.stop_time:
-                break
-            
-            try:
-                values = struct.unpack(format, sample)
-            except struct.error:
-                raise StopIteration
-            
-            value = values[0]
-            
             if self.filter_:
+                length = len(values)
+                values = self.despike(values)
+                # Time passes while the first values are buffered.
+                self.T += (length - len(values)) * self.dt
             
-                buf.append(value)
-                
-                if len(buf) < 4:
-                    self.T += self.dt
-                    continue
-                
-                #print "", buf[0], buf[1], buf[2]
-                
-                # Check for a point that crosses the zero line out of sequence.
-                if buf[0] * buf[1] < 0 and buf[0] * buf[2] > 0:
-                
-                    # Check for another crossing.
-                    if buf[1] * buf[3] > 0:
-                        # Interpolate the two middle points.
-                        if self.debug:
-                            print >>sys.stderr, " double spike at", hms(self.T), buf[0], buf[1], buf[2], buf[3], "->", (buf[1] + buf[3])/2.0
-                        buf[1] = ((2 * buf[0]) + buf[3])/3.0
-                        buf[2] = (buf[0] + (2 * buf[3]))/3.0
-                    else:
-                        # Interpolate the second point.
-                        if self.debug:
-                            print >>sys.stderr, " single spike at", hms(self.T), buf[0], buf[1], buf[2], buf[3], "->", (buf[0] + buf[2])/2.0
-                        buf[1] = (buf[0] + buf[2])/2.0
-                
-                else:
-                    b0 = buf[1] - buf[0]
-                    b1 = buf[2] - buf[1]
-                    b2 = buf[3] - buf[2]
-                    if b0 * b1 < 0 and b0 * b2 > 0:
-                    
-                        # Interpolate the second point.
-                        if self.debug:
-                            print >>sys.stderr, " smoothing", hms(self.T), buf[0], buf[1], buf[2], buf[3], "->", (buf[0] + buf[2])/2.0
-                        buf[2] = (buf[1] + buf[3])/2.0
-                
-                value = buf.pop(0)
-                #print >>sys.stderr, value
-            
-            mean = ((mean * (mean_count - 1)) + value)/mean_count
+            y, means, Vc1, Vc2 = self.filter(values)
             
-            Vapp = (value - mean) * self.boost_factor/8.0
-            # Apply the low-pass filter.
-            Vc1, i1 = self.V(Vc1, Vapp, R1, C1, self.dt)
-            # Apply the high-pass filter to the output of the low-pass filter.
-            Vc2, i2 = self.V(Vc2, Vc1, R2, C2, self.dt)
+            T0 = self.T
+            dt = self.dt
             
-            y = max(0.0, min(i2 * R2, 1.0))
-            dy = y - old_y
+            # Only use the values up to the stop time.
+            stopped = False
+            if self.stop_time != None:
+                times = T0 + np.arange(len(y)) * dt
+                used = np.searchsorted(times, self.stop_time, side = "right")
+                if used < len(y):
+                    y = y[:used]
+                    stopped = True
             
-            self.ymax = max(y, self.ymax)
-            
-            if self.debug:
-                f.write(struct.pack("<b", y * 127))
-            
-            if old_y == 0 and y > 0 and start_t is None:
-            
-                start_t = self.T
-                self.ymax = 0
-                #print >>sys.stderr, "> %.5f" % (self.T - self.start_time)
-            
-            if dy < 0 and y == 0:
+            if len(y) > 0:
+                indices, centres, widths, peaks = finder.find(y, T0, dt)
+            else:
+                indices = []
             
-                end_t = self.T
-                floor_count = 0
-                #print >>sys.stderr, "< %.5f" % (self.T - self.start_time)
+            # The buffer is filtered once using the sample period in use at
+            # its start. If the period is adapted part of the way through the
+            # buffer, the times of later pulses are measured from the point
+            # of the change using the new period.
+            seg_index = 0
+            seg_T = T0
+            seg_dt = dt
             
-            elif y == 0 and start_t != None:
+            for k in xrange(len(indices)):
             
-                floor_count += 1
+                self.last_tc = tc
+                tc = centres[k]
+                width = widths[k]
                 
-                #print >>sys.stderr, "?", floor_count, zero_count
+                if seg_dt != dt:
+                    tc = seg_T + ((tc - T0)/dt - seg_index) * seg_dt
+                    width = width * (seg_dt/dt)
                 
-                if floor_count >= zero_count:
+                if self.debug:
+                    print >>sys.stderr, "%.5f" % (tc - self.start_time), \
+                    width/self.width_1200, width/self.width_2400
                 
-                    self.last_tc = tc
-                    tc = (start_t + end_t)/2.0
-                    width = end_t - start_t
-                    
-                    if self.debug:
-                        print >>sys.stderr, "%.5f" % (tc - self.start_time), \
-                        width/self.width_1200, width/self.width_2400
-                    
-                    if self.ymax > 0.1:
+                if peaks[k] > 0.1:
+                    self.T = seg_T + (indices[k] - seg_index) * seg_dt
+                    self.ymax = peaks[k]
+                    try:
                         result = self.process_pulse(tc, width)
-                        if result != None:
-                            yield result
+                    except ValueError:
+                        if not self.resilient:
+                            raise
+                        # Wait for the next high tone and tell the
+                        # block reader that synchronisation was lost.
+                        self.state = "waiting"
+                        self.shift = 0
+                        self.cycles = 0
+                        result = None
+                        yield None
+                    
+                    if result != None:
+                        yield result
                     
-                    floor_count = 0
-                    start_t = None
+                    if self.dt != seg_dt:
+                        seg_T = self.T
+                        seg_index = indices[k]
+                        seg_dt = self.dt
             
-            if not self.debug and not quiet:
-                sys.stdout.write("\r%s " % hms(self.T))
+            if stopped:
+                return
             
-            old_y = y
-            self.T += self.dt
+            # Record the state of the filters after the last value used.
+            j = len(y) - 1
+            if j >= 0:
+                self.mean = means[j]
+                self.Vc1 = Vc1[j]
+                self.Vc2 = Vc2[j]
+            self.T = seg_T + (j - seg_index) * seg_dt + self.dt
+            
+            if self.debug:
+                f.write((y * 127).astype(np.int8).tostring())
+            
+            if self.progress:
+                self.progress.update(self.T)
+    
+    def checked_bytes(self, gen):
+    
+        """Passes on the bytes from the generator given, stopping with an
+        exception if synchronisation with the signal is lost or if the audio
+        ends, or the stop time is reached, before the block is complete."""
+        
+        for byte in gen:
+            if byte is None:
+                raise ValueError("Lost synchronisation at %s." % hms(self.T))
+            yield byte
+        
+        raise ValueError("Block cut off at %s." % hms(self.T))
     
     def read_block(self, audio_f):
     
@@ -461,12 +505,33 @@ class Reader:
         
             byte = gen.next()
             
-            if byte == 0x2a:
+            if byte is None:
+                # Synchronisation was lost outside a block, possibly in the
+                # leader of a block that will not be found.
+                self.add_failure(self.T, "Lost synchronisation at %s." % (
+                    hms(self.T)))
+            
+            elif byte == 0x2a:
+                start = self.T
                 try:
                     #print ">", self.T
-                    yield Block(self.T, gen, self.debug)
-                except ValueError:
-                    raise
+                    yield Block(self.T, self.checked_bytes(gen), self.debug)
+                except ValueError, exc:
+                    if not self.resilient:
+                        raise
+                    self.add_failure(start, str(exc))
+    
+    def add_failure(self, start, message):
+    
+        """Records a region of the recording, from the start time given to
+        the current time, that could not be decoded. Regions that start
+        shortly after the previous one ends are combined with it."""
+        
+        if self.failures and start - self.failures[-1][1] < self.failure_gap:
+            previous_start, previous_end, message = self.failures.pop()
+            start = min(start, previous_start)
+        
+        self.failures.append((start, self.T, message))
 
 
 def check_wav(f, mono, sample_rate, sample_size):
@@ -475,28 +540,320 @@ def check_wav(f, mono, sample_rate, sample_size):
         f.seek(0, 0)
         return mono, sample_rate, sample_size
     
-    f.seek(4, 1)
+    details = audioUEF.read_wav_header(f)
+    f.seek(details["data_offset"], 0)
+    
+    return details["channels"] == 1, details["sample_rate"], \
+           details["sample_size"]
+
+
+def find_split_times(audio_f, format, step, sample_rate, min_length = 0.5,
+                     window = 0.01):
+
+    """Reads the audio file from its current position, returning a list of
+    times, relative to that position, in the middle of silences lasting at
+    least min_length seconds. No block can be recorded across these times,
+    so the audio can be divided at them into pieces that can be decoded
+    independently.
+
+    Stretches of carrier tone are not used because they cannot be told apart
+    from runs of &FF bytes inside blocks without decoding them."""
+
+    size = max(1, int(window * sample_rate))
+    peaks = []
+    left = np.zeros(0)
+    
+    for values in audioUEF.read_samples(audio_f, format, step):
+    
+        values = np.append(left, values)
+        count = len(values) / size
+        left = values[count * size:]
+        
+        windows = values[:count * size].reshape(count, size)
+        windows = windows - windows.mean(axis = 1)[:, np.newaxis]
+        peaks.append(abs(windows).max(axis = 1))
+    
+    if not peaks:
+        return []
+    
+    peaks = np.concatenate(peaks)
+    
+    # Windows are silent if they are much quieter than the loudest window.
+    silent = peaks < 0.05 * peaks.max()
+    
+    # Find the runs of silent windows, which are safe to divide.
+    edges = np.diff(np.concatenate(([0], silent.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    
+    long_runs = (ends - starts) * size >= min_length * sample_rate
+    middles = (starts[long_runs] + ends[long_runs]) / 2.0
+    return list(middles * size / float(sample_rate))
+
+
+def decode_piece(task):
+
+    """Decodes the blocks in a piece of an audio file, returning a list of
+    blocks, a message describing any error that stopped the decoding and, if
+    the resilient flag in the task is set, a list of the blocks that could
+    not be read."""
+
+    audio_file, offset, channel, format, step, sample_rate, reader_args, \
+        start_time, stop_time, resilient = task
+    
+    if offset is None:
+        audio_f = audioUEF.WavFile(audio_file, channel)
+        audio_f.seek(int(round(start_time * sample_rate)))
+    else:
+        audio_f = open(audio_file, "rb")
+        audio_f.seek(offset + int(round(start_time * sample_rate)) * step)
     
-    if f.read(4) != "WAVE":
-        raise IOError("Not a WAV file I understand.")
+    reader = Reader(format, step, sample_rate, *reader_args)
+    reader.progress = None
+    reader.resilient = resilient
+    reader.start_at(start_time)
+    if stop_time != None:
+        reader.stop_at(stop_time)
     
-    if f.read(4) != "fmt ":
-        raise IOError("Not a WAV file I understand.")
+    blocks = []
+    error = None
     
-    header_size = struct.unpack("<I", f.read(4))[0]
+    try:
+        for block in reader.read_block(audio_f):
+            blocks.append(block)
+    except Exception, exc:
+        error = str(exc)
     
-    f.seek(4, 1)
-    sample_rate = struct.unpack("<I", f.read(4))[0]
-    f.seek(6, 1)
+    audio_f.close()
+    return blocks, error, reader.failures
+
+
+def decode_in_parallel(audio_file, offset, format, step, sample_rate,
+                       reader_args, start_time, stop_time, processes,
+                       channel = 0, resilient = False):
+
+    """Divides the audio file, starting at the given offset in bytes, into
+    pieces at silences, then decodes the pieces between the start and stop
+    times in separate processes. Yields the list of blocks, any error message
+    and the list of blocks that could not be read for each piece in the order
+    in which they occur in the file.
+
+    If the offset is None, the file is read as a WAV file using the channel
+    given."""
+
+    if offset is None:
+        audio_f = audioUEF.WavFile(audio_file, channel)
+    else:
+        audio_f = open(audio_file, "rb")
+        audio_f.seek(offset)
+    
+    split_times = find_split_times(audio_f, format, step, sample_rate)
+    audio_f.close()
+    
+    # Round the times to whole frames so that each piece starts at the
+    # time given to its reader.
+    times = [start_time]
+    for t in split_times:
+        t = round(t * sample_rate) / float(sample_rate)
+        if t > start_time and (stop_time == None or t < stop_time):
+            times.append(t)
+    times.append(stop_time)
+    
+    tasks = []
+    for i in range(len(times) - 1):
+        tasks.append((audio_file, offset, channel, format, step, sample_rate,
+                      reader_args, times[i], times[i + 1], resilient))
+    
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap(decode_piece, tasks):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def merge_blocks(block_lists, tolerance = 0.1):
+
+    """Merges lists of blocks decoded from the same recording, returning a
+    list of (block, index) pairs in time order, where index is the position
+    of the list the block was taken from. Blocks with the same name and
+    number that start within the tolerance given, in seconds, of each other
+    are the same block, which is taken from the first list containing it."""
+
+    entries = []
+    for index in range(len(block_lists)):
+        for block in block_lists[index]:
+            entries.append((block.T, index, block))
+    
+    entries.sort()
+    merged = []
+    
+    for T, index, block in entries:
+    
+        i = len(merged) - 1
+        while i >= 0 and T - merged[i][0].T < tolerance:
+            kept, kept_index = merged[i]
+            if kept.name == block.name and kept.number == block.number:
+                if index < kept_index:
+                    merged[i] = (block, index)
+                break
+            i -= 1
+        else:
+            merged.append((block, index))
     
-    sample_size = struct.unpack("<H", f.read(2))[0]
+    return merged
+
+
+def decode_and_merge(tasks, processes = None):
+
+    """Decodes the pieces described by the list of tasks given in a pool of
+    processes, continuing past any blocks that cannot be read. Returns the
+    merged list of (block, index) pairs, where index is the position of the
+    task that produced the block, and a list of the failures that were not
+    recovered by any task."""
+
+    pool = multiprocessing.Pool(processes or None)
+    try:
+        results = pool.map(decode_piece, tasks)
+    finally:
+        pool.terminate()
     
-    if f.read(4) != "data":
-        raise IOError("Not a WAV file I understand.")
+    merged = merge_blocks([blocks for blocks, error, failures in results])
     
-    f.seek(4, 1)
+    failures = []
+    for blocks, error, piece_failures in results:
+        failures += piece_failures
     
-    return mono, sample_rate, sample_size
+    return merged, unrecovered_failures(failures,
+                        map(lambda (block, index): block, merged))
+
+
+def unrecovered_failures(failures, blocks, tolerance = 0.1):
+
+    """Returns the failures in the list given, in time order, for which none
+    of the blocks given start within the region that could not be decoded.
+    Duplicate failures found by different decodings of the same recording
+    are only returned once."""
+
+    unrecovered = []
+    
+    for start, end, message in sorted(failures):
+    
+        for block in blocks:
+            if start - tolerance < block.T < end + tolerance:
+                break
+        else:
+            if not unrecovered or start - unrecovered[-1][0] >= tolerance:
+                unrecovered.append((start, end, message))
+    
+    return unrecovered
+
+
+def decode_tasks(sources, grid, format, step, sample_rate, adapt_frequency,
+                 debug, ranges):
+
+    """Returns a list of tasks for decode_piece that decode each of the
+    (start time, stop time) ranges given using every set of parameters in
+    the grid for each of the (audio file, offset, channel) sources given.
+    The tasks for each range are ordered by parameter set and then by
+    source."""
+
+    tasks = []
+    
+    for start_time, stop_time in ranges:
+        for parameters in grid:
+        
+            reader_args = (parameters["boost"], parameters["f1"],
+                           parameters["f2"], 1/parameters["w1200"],
+                           1/parameters["w2400"], int(parameters["zc"]),
+                           bool(parameters["filter"]),
+                           adapt_frequency, True, debug)
+            
+            for path, offset, channel in sources:
+                tasks.append((path, offset, channel, format, step,
+                              sample_rate, reader_args, start_time,
+                              stop_time, True))
+    
+    return tasks
+
+
+sweep_options = ("boost", "f1", "f2", "w1200", "w2400", "zc", "filter")
+
+def parameter_grid(text, defaults):
+
+    """Returns a list of dictionaries containing every combination of the
+    values given in the text, which has the form
+    
+    <option>=<value>,<value>,...;<option>=<value>,...
+    
+    where each option is one of the names in sweep_options. Options not in
+    the text take their values from the defaults dictionary."""
+
+    grid = [dict(defaults)]
+    
+    for item in text.split(";"):
+    
+        if not item.strip():
+            continue
+        
+        name, values = item.split("=", 1)
+        name = name.strip()
+        if name not in sweep_options:
+            raise ValueError("Unknown sweep option: %s" % name)
+        
+        values = map(float, values.split(","))
+        new_grid = []
+        for parameters in grid:
+            for value in values:
+                parameters = dict(parameters)
+                parameters[name] = value
+                new_grid.append(parameters)
+        
+        grid = new_grid
+    
+    return grid
+
+
+def describe_parameters(parameters):
+
+    return " ".join(map(lambda name: "%s=%g" % (name, parameters[name]),
+                        sweep_options))
+
+
+# The settings tried when decoding the regions that could not be read
+retry_settings = "filter=0,1;boost=1,2;zc=6200,4000"
+
+def block_chunks(u, block):
+
+    """Returns the chunks used to represent the block given in the UEF file
+    given, including the tones and gaps around it."""
+
+    if block.number == 0:
+        chunks = [(0x112, u.number(2, 0x5dc)),
+                  (0x110, u.number(2, 0x5dc)),
+                  (0x100, u.number(1, 0xdc)),
+                  (0x110, u.number(2, 0x5dc))]
+    else:
+        chunks = [(0x110, u.number(2, 0x258))]
+    
+    chunks.append((0x100, block.data()))
+    
+    if block.length < 256 or block.flags & 0x80:
+        chunks.append((0x110, u.number(2, 0x258)))
+    
+    return chunks
+
+
+def describe_block(block, debug):
+
+    if not debug:
+        return " ".join(map(str, (hms(block.T), block.name,
+            hex(block.load_addr), hex(block.exec_addr), hex(block.number),
+            block.length, hex(block.flags))))
+    else:
+        return " ".join(map(str, ("%.2f (%s)" % (block.T, hms(block.T)),
+            block.name, hex(block.load_addr), hex(block.exec_addr),
+            hex(block.number), block.length, hex(block.flags))))
 
 
 if __name__ == "__main__":
@@ -520,25 +877,78 @@ if __name__ == "__main__":
     filter_ = find_option(args, "--filter", 0)
     adapt_frequency = find_option(args, "--adapt", 0)
     quiet = find_option(args, "--quiet", 0)
+    use_processes, processes = find_option(args, "--processes", 1)
+    both = find_option(args, "--both", 0)
+    sweep, sweep_grid = find_option(args, "--sweep", 1)
+    resilient = find_option(args, "--resilient", 0)
+    retry, retry_grid = find_option(args, "--retry", 1)
     
     if len(args) != 2:
-        sys.stderr.write("Usage: %s [--rate <sample rate in Hz>] [--mono] [--unsigned] [--size <sample size in bits>] [--start <time in seconds>] [--stop <time in seconds>] [--boost <factor>] [--filter] <audio file> <UEF file>\n" % program_name)
+        sys.stderr.write("Usage: %s [--rate <sample rate in Hz>] [--mono] [--unsigned] [--size <sample size in bits>] [--start <time in seconds>] [--stop <time in seconds>] [--boost <factor>] [--filter] [--processes <number>] [--both] [--sweep <option>=<values>;...] [--resilient] [--retry <option>=<values>;...] <audio file> <UEF file>\n" % program_name)
         sys.exit(1)
     
     audio_file = args[0]
     uef_file = args[1]
     
+    wav = None
+    stream = None
+    
     if audio_file == "-":
-        audio_f = sys.stdin
+        # Read standard input through a buffer of fixed size, reading the
+        # header first if it contains a WAV file.
+        audio_f = stream = audioUEF.AudioStream(sys.stdin)
+        header = stream.read(4)
+        stream.unread(header)
+        
+        if header == "RIFF":
+            try:
+                stream.read_wav_header(int(right))
+            except IOError, exc:
+                sys.stderr.write(str(exc) + "\n")
+                sys.exit(1)
+            
+            mono = True
+            if not r:
+                sample_rate = stream.sample_rate
+            if stream.sample_size == 8 and not stream.floating:
+                sample_size = 8
+            else:
+                sample_size = 16
+            s = r = True
     else:
         audio_f = open(audio_file, "rb")
-        mono, wav_sample_rate, sample_size = check_wav(audio_f, mono, sample_rate, sample_size)
-        if not r:
-            sample_rate = wav_sample_rate
+        is_wav = audio_f.read(4) == "RIFF"
+        audio_f.seek(0, 0)
+        
+        if is_wav:
+            # Read WAV files through a memory map, selecting the channel to
+            # use and converting the samples to the range of 8 or 16-bit
+            # signed values.
+            try:
+                wav = audioUEF.WavFile(audio_file, int(right))
+            except IOError, exc:
+                sys.stderr.write(str(exc) + "\n")
+                sys.exit(1)
+            
+            audio_f.close()
+            audio_f = wav
+            mono = True
+            
+            if both and wav.channels < 2:
+                sys.stderr.write("Cannot decode both channels of a mono file.\n")
+                sys.exit(1)
+            
+            if not r:
+                sample_rate = wav.sample_rate
+            if wav.sample_size == 8 and not wav.floating:
+                sample_size = 8
+            else:
+                sample_size = 16
+        
         s = r = True
     
     if not s or not r:
-        sys.stderr.write("Usage: %s [--rate <sample rate in Hz>] [--mono] [--unsigned] [--size <sample size in bits>] [--start <time in seconds>] [--stop <time in seconds>] [--boost <factor>] [--filter] <audio file> <UEF file>\n" % program_name)
+        sys.stderr.write("Usage: %s [--rate <sample rate in Hz>] [--mono] [--unsigned] [--size <sample size in bits>] [--start <time in seconds>] [--stop <time in seconds>] [--boost <factor>] [--filter] [--processes <number>] [--both] [--sweep <option>=<values>;...] [--resilient] [--retry <option>=<values>;...] <audio file> <UEF file>\n" % program_name)
         sys.exit(1)
     
     dt = 1.0/float(sample_rate)
@@ -586,7 +996,7 @@ if __name__ == "__main__":
     
     step = int(sample_size/8)
     
-    if right:
+    if right and not wav and not stream:
         audio_f.seek(step, 1)
     
     if sample_size == 8:
@@ -599,59 +1009,275 @@ if __name__ == "__main__":
         format = format * 2
     
     format = "<" + format
+    
+    if stream and stream.buffer is None:
+        stream.set_raw_format(format, step, int(right))
+    
     reader = Reader(format, step, int(sample_rate), float(boost_factor),
                     f1, f2, width_1200, width_2400, zero_count,
                     filter_, adapt_frequency, quiet, debug)
     reader.start_at(float(start_time))
-    print "Seeking to", float(start_time)
-    audio_f.seek(step * float(start_time) * int(sample_rate), 1)
     
     if stop:
-        reader.stop_at(from_hms(stop_time))
+        stop_time = from_hms(stop_time)
+        reader.stop_at(stop_time)
+    else:
+        stop_time = None
+    
+    # Create the UEF file before decoding so that blocks can be written to it
+    # as they are found.
+    u = UEFfile.UEFfile(creator = 'recordUEF.py ' + version)
+    u.minor = 6
+    u.target_machine = "Electron"
+    
+    try:
+        writer = u.writer(uef_file, write_emulator_info = False)
+    except UEFfile.UEFfile_error:
+        sys.stderr.write("Couldn't write the new executable to %s.\n" % uef_file)
+        sys.exit(1)
     
     last_T = 0
     data = []
     blocks = []
+    failures = []
     
-    try:
-        for block in reader.read_block(audio_f):
-            if not debug:
-                print hms(block.T), block.name, hex(block.load_addr), hex(block.exec_addr), hex(block.number), block.length, hex(block.flags)
-            else:
-                print "%.2f (%s)" % (block.T, hms(block.T)), block.name, hex(block.load_addr), hex(block.exec_addr), hex(block.number), block.length, hex(block.flags)
+    defaults = {"boost": float(boost_factor), "f1": f1, "f2": f2,
+                "w1200": 1/width_1200, "w2400": 1/width_2400,
+                "zc": zero_count, "filter": int(filter_)}
+    
+    if use_processes:
+        processes = int(processes) or None
+    else:
+        processes = None
+    
+    # Describe the channels that are read again by the modes that decode
+    # the recording more than once.
+    if audio_file == "-":
+        sources = []
+    elif not both:
+        if wav:
+            sources = [(audio_file, None, int(right))]
+        else:
+            sources = [(audio_file, audio_f.tell(), int(right))]
+    elif wav:
+        sources = [(audio_file, None, 0), (audio_file, None, 1)]
+    elif mono:
+        sys.stderr.write("Cannot decode both channels of a mono file.\n")
+        sys.exit(1)
+    else:
+        offset = audio_f.tell()
+        if right:
+            offset -= step / 2
+        sources = [(audio_file, offset, 0),
+                   (audio_file, offset + step / 2, 1)]
+    
+    if both or sweep:
+    
+        # Decode each channel, or each set of parameters, in a separate
+        # process and take each block from the first decoding that produced
+        # it with valid checksums.
+        if audio_file == "-":
+            sys.stderr.write("Cannot decode standard input more than once.\n")
+            sys.exit(1)
+        
+        if sweep:
+            try:
+                grid = parameter_grid(sweep_grid, defaults)
+            except ValueError, exc:
+                sys.stderr.write("Invalid sweep: %s\n" % exc)
+                sys.exit(1)
+        else:
+            grid = [defaults]
+        
+        tasks = decode_tasks(sources, grid, format, step, int(sample_rate),
+                             adapt_frequency, debug,
+                             [(float(start_time), stop_time)])
+        
+        merged, failures = decode_and_merge(tasks, processes)
+        
+        counts = [0] * len(tasks)
+        for block, index in merged:
+            label = []
+            if sweep:
+                label.append("#%i" % (index / len(sources)))
+            if both:
+                label.append("LR"[index % len(sources)])
+            print describe_block(block, debug), " ".join(label)
+            writer.write_chunks(block_chunks(u, block))
+            writer.flush()
             blocks.append(block)
+            counts[index] += 1
+        
+        print
+        print "Blocks taken from each decoding:"
+        for index in range(len(tasks)):
+            label = []
+            if sweep:
+                label.append("#%i" % (index / len(sources)))
+            if both:
+                label.append(["left", "right"][index % len(sources)])
+            print "%4i" % counts[index], " ".join(label),
+            if sweep:
+                print "(%s)" % describe_parameters(grid[index / len(sources)])
+            else:
+                print
+        
+        pieces = []
+    
+    elif use_processes:
+    
+        # Divide the recording into pieces that are decoded in parallel.
+        if audio_file == "-":
+            sys.stderr.write("Cannot decode standard input in parallel.\n")
+            sys.exit(1)
+        
+        if wav:
+            offset = None
+        else:
+            offset = audio_f.tell()
+        
+        reader_args = (float(boost_factor), f1, f2, width_1200, width_2400,
+                       zero_count, filter_, adapt_frequency, True, debug)
+        
+        pieces = decode_in_parallel(audio_file, offset, format, step,
+                    int(sample_rate), reader_args, float(start_time),
+                    stop_time, processes, int(right), resilient)
+    else:
+        print "Seeking to", float(start_time)
+        if wav:
+            wav.seek(int(round(float(start_time) * int(sample_rate))))
+        elif stream:
+            stream.skip(int(round(float(start_time) * int(sample_rate))))
+        else:
+            audio_f.seek(step * float(start_time) * int(sample_rate), 1)
+        reader.resilient = resilient
+        pieces = [(reader.read_block(audio_f), None, reader.failures)]
+    
+    try:
+        for piece, error, piece_failures in pieces:
+            for block in piece:
+                print describe_block(block, debug)
+                sys.stdout.flush()
+                
+                # Write each block to the file as soon as it is found, so
+                # that the file holds every block read so far even during
+                # long silences or if decoding fails.
+                writer.write_chunks(block_chunks(u, block))
+                writer.flush()
+                
+                # Only keep the blocks if they are needed to find the
+                # regions to decode again.
+                if resilient:
+                    blocks.append(block)
+            
+            if error:
+                raise ValueError(error)
+            failures += piece_failures
     except:
+        if reader.progress:
+            reader.progress.finish()
         exc_type, exc, tb = sys.exc_info()
         sys.stderr.write(str(exc) + "\n")
+        
+        # Keep the blocks already written.
+        try:
+            writer.close()
+        except UEFfile.UEFfile_error:
+            pass
         sys.exit(1)
     
-    if not debug:
-        print
-    
-    u = UEFfile.UEFfile(creator = 'recordUEF.py ' + version)
-    u.minor = 6
-    u.target_machine = "Electron"
+    if reader.progress:
+        reader.progress.finish()
     
-    for block in blocks:
+    if failures and resilient and sources:
     
-        if block.number == 0:
-            u.chunks += [(0x112, u.number(2, 0x5dc)),
-                         (0x110, u.number(2, 0x5dc)),
-                         (0x100, u.number(1, 0xdc)),
-                         (0x110, u.number(2, 0x5dc))]
+        # Decode only the regions that could not be read, using other
+        # settings, and merge any blocks recovered with those already found.
+        if retry:
+            text = retry_grid
         else:
-            u.chunks.append((0x110, u.number(2, 0x258)))
+            text = retry_settings
+        
+        try:
+            grid = parameter_grid(text, defaults)
+        except ValueError, exc:
+            sys.stderr.write("Invalid retry settings: %s\n" % exc)
+            sys.exit(1)
+        
+        grid = filter(lambda parameters: parameters != defaults, grid)
+        
+        # Each region runs from the start of the last block read before a
+        # failure to the start of the first block read after it.
+        ranges = []
+        for start, end, message in failures:
+        
+            retry_start = float(start_time)
+            retry_stop = stop_time
+            for block in blocks:
+                if block.T < start:
+                    retry_start = max(retry_start, block.T)
+                elif block.T > end and (retry_stop == None or block.T < retry_stop):
+                    retry_stop = block.T
+            
+            if not ranges or retry_start != ranges[-1][0]:
+                ranges.append((retry_start, retry_stop))
+        
+        print
+        print "Decoding %i regions again with %i other settings" % (
+            len(ranges), len(grid))
         
-        u.chunks.append((0x100, block.data()))
+        tasks = decode_tasks(sources, grid, format, step, int(sample_rate),
+                             adapt_frequency, debug, ranges)
+        recovered, retry_failures = decode_and_merge(tasks, processes)
         
-        if block.length < 256 or block.flags & 0x80:
-            u.chunks.append((0x110, u.number(2, 0x258)))
+        merged = merge_blocks([blocks, map(lambda (block, index): block,
+                                           recovered)])
+        
+        used = len(sources) * len(grid)
+        for block, index in recovered:
+            if (block, 1) in merged:
+                parameters = grid[(index % used) / len(sources)]
+                print describe_block(block, debug), \
+                      "(%s)" % describe_parameters(parameters)
+        
+        if len(merged) > len(blocks):
+        
+            # Write the file again with the recovered blocks in place,
+            # replacing the blocks written while decoding.
+            blocks = map(lambda (block, index): block, merged)
+            try:
+                writer.close()
+                writer = u.writer(uef_file, write_emulator_info = False)
+                for block in blocks:
+                    writer.write_chunks(block_chunks(u, block))
+            except UEFfile.UEFfile_error:
+                sys.stderr.write("Couldn't write the new executable to %s.\n" % uef_file)
+                sys.exit(1)
+        
+        failures = unrecovered_failures(failures, blocks)
+        
+        # Report any blocks still missing from the files found.
+        for previous, block in zip(blocks, blocks[1:]):
+            if block.name != previous.name:
+                continue
+            if block.number == previous.number + 2:
+                sys.stderr.write("Missing block %x of %s.\n" % (
+                    previous.number + 1, block.name))
+            elif block.number > previous.number + 2:
+                sys.stderr.write("Missing blocks %x to %x of %s.\n" % (
+                    previous.number + 1, block.number - 1, block.name))
     
-    # Write the new UEF file.
     try:
-        u.write(uef_file, write_emulator_info = False)
+        writer.close()
     except UEFfile.UEFfile_error:
         sys.stderr.write("Couldn't write the new executable to %s.\n" % uef_file)
         sys.exit(1)
     
+    if failures:
+        for start, end, message in failures:
+            sys.stderr.write(message + "\n")
+        if not resilient:
+            sys.exit(1)
+        sys.stderr.write("%i regions could not be decoded.\n" % len(failures))
+    
     #sys.exit()
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+"""
+renderUEF.py - Convert UEF files into audio files.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import struct, sys, wave
+import numpy as np
+import UEFfile
+
+version = "0.1"
+
+def find_option(args, label, number = 0):
+
+    """Matches an option in a list of command line arguments, returning a
+    single boolean value for options without arguments and a tuple for options
+    with arguments.
+
+    For options with arguments, the tuple contains a boolean value and a list
+    of arguments found unless only one argument is expected, in which case the
+    value itself is included in the tuple instead of a list.
+
+    If the boolean value is True, the option was found. If it is False then
+    either it was not found or the required number of arguments was not found.
+    """
+
+    try:
+        i = args.index(label)
+    except ValueError:
+        if number == 0:
+            return False
+        else:
+            return False, None
+
+    values = args[i + 1:i + number + 1]
+    args[:] = args[:i] + args[i + number + 1:]
+
+    if number == 0:
+        return True
+
+    if len(values) < number:
+        return False, values
+
+    if number == 1:
+        values = values[0]
+
+    return True, values
+
+
+def number(s):
+
+    """Converts a string of bytes to a little endian integer."""
+
+    n = 0
+    for i in range(len(s) - 1, -1, -1):
+        n = (n << 8) | ord(s[i])
+
+    return n
+
+
+class Renderer:
+
+    """Generates the audio samples for the chunks of a UEF file.
+
+    Each bit is encoded as cycles of the base frequency (zero) or twice the
+    base frequency (one) and high tone as cycles of twice the base frequency.
+    Samples are produced from a table containing a single cycle of the
+    waveform for each whole number of samples a cycle can occupy, so that the
+    samples for a run of cycles can be gathered from the table in one step.
+    The start of each cycle is rounded to the nearest sample, keeping the
+    average frequency exact when a cycle does not fit a whole number of
+    samples.
+    """
+
+    # The number of samples written at once for long gaps
+    gap_samples = 65536
+
+    def __init__(self, sample_rate = 44100, amplitude = 0.75):
+
+        self.sample_rate = sample_rate
+        self.amplitude = amplitude
+
+        # Time in seconds of the start of the next sample to be generated
+        self.T = 0.0
+        self.samples = 0
+
+        self.set_base_frequency(1200.0)
+        self.baud = 1200
+
+    def set_base_frequency(self, base):
+
+        self.base = base
+        # The time taken by a cycle of high tone
+        self.short_time = 0.5 / base
+
+        # Create a table of cycles for each possible length of a long cycle
+        # and anything shorter. Bits at baud rates that are not a whole
+        # fraction of 1200 baud can stretch long cycles by up to half.
+        max_length = int(np.ceil(3 * self.short_time * self.sample_rate)) + 1
+        lengths = np.arange(max_length + 1)
+        positions = np.arange(max_length)
+
+        periods = np.maximum(lengths, 1)[:, np.newaxis].astype(float)
+        phases = positions[np.newaxis, :] / periods
+        self.table = np.where(positions[np.newaxis, :] < lengths[:, np.newaxis],
+                              np.sin(2 * np.pi * phases) * self.amplitude, 0.0)
+
+    def cycles(self, units):
+
+        """Returns samples for the cycles described by the array of units
+        given, where each unit is the length of a cycle of high tone, and
+        updates the current time."""
+
+        if len(units) == 0:
+            return np.zeros(0)
+
+        ends = self.T + np.cumsum(units) * self.short_time
+        boundaries = np.empty(len(units) + 1, dtype = np.int64)
+        boundaries[0] = self.samples
+        boundaries[1:] = np.rint(ends * self.sample_rate)
+
+        lengths = np.diff(boundaries)
+        total = boundaries[-1] - boundaries[0]
+
+        starts = boundaries[:-1] - boundaries[0]
+        offsets = np.arange(total) - np.repeat(starts, lengths)
+
+        self.T = ends[-1]
+        self.samples = boundaries[-1]
+
+        return self.table[np.repeat(lengths, lengths), offsets]
+
+    def bits(self, bits):
+
+        """Returns samples for the array of bits given."""
+
+        # At 1200 baud, a zero is a single cycle of the base frequency and a
+        # one is two cycles of twice the base frequency. Lower baud rates use
+        # proportionally more cycles for each bit. The cycles are stretched or
+        # squeezed so that each bit lasts as long as the baud rate requires,
+        # which makes the cycles shorter for baud rates above 1200.
+        repeat = max(1, int(round(1200.0 / self.baud)))
+        scale = 1200.0 / self.baud / repeat
+        counts = np.where(bits, 2 * repeat, repeat)
+        units = np.repeat(2 - bits.astype(np.int64), counts) * scale
+        return self.cycles(units)
+
+    def byte_bits(self, data, bits = 8, parity = 'N', stop_bits = 1):
+
+        """Returns an array of bits for the string of bytes given, including
+        start, parity and stop bits for each byte."""
+
+        values = np.fromstring(data, dtype = np.uint8)
+
+        # Unpack the bits of each byte with the least significant bit first.
+        data_bits = np.unpackbits(values[:, np.newaxis], axis = 1)[:, ::-1]
+        data_bits = data_bits[:, :bits]
+
+        columns = [np.zeros((len(values), 1), dtype = np.uint8), data_bits]
+
+        if parity != 'N':
+            odd = (data_bits.sum(axis = 1) % 2)[:, np.newaxis]
+            if parity == 'O':
+                odd = 1 - odd
+            columns.append(odd.astype(np.uint8))
+
+        columns.append(np.ones((len(values), stop_bits), dtype = np.uint8))
+
+        return np.hstack(columns).ravel()
+
+    def tone(self, cycles):
+
+        return self.cycles(np.ones(cycles, dtype = np.int64))
+
+    def gap(self, duration):
+
+        """Yields arrays of silence lasting the given number of seconds."""
+
+        self.T = self.T + duration
+        end = int(np.rint(self.T * self.sample_rate))
+
+        while self.samples < end:
+            length = min(end - self.samples, self.gap_samples)
+            self.samples = self.samples + length
+            yield np.zeros(length)
+
+    def render(self, chunks):
+
+        """Yields arrays of samples, with values between -1 and 1, for the
+        list of chunks given."""
+
+        for chunk_id, data in chunks:
+
+            if chunk_id == 0x100:
+                yield self.bits(self.byte_bits(data))
+
+            elif chunk_id == 0x102:
+                if data:
+                    count = (len(data) - 1) * 8 - ord(data[0])
+                    values = np.fromstring(data[1:], dtype = np.uint8)
+                    bits = np.unpackbits(values[:, np.newaxis], axis = 1)[:, ::-1]
+                    yield self.bits(bits.ravel()[:count])
+
+            elif chunk_id == 0x104:
+                if len(data) >= 3:
+                    stop_bits = struct.unpack("<b", data[2])[0]
+                    yield self.bits(self.byte_bits(data[3:], ord(data[0]),
+                                                   data[1], abs(stop_bits)))
+
+            elif chunk_id == 0x110:
+                yield self.tone(number(data))
+
+            elif chunk_id == 0x111:
+                yield self.tone(number(data[:2]))
+                yield self.bits(self.byte_bits("\xaa"))
+                yield self.tone(number(data[2:4]))
+
+            elif chunk_id == 0x112:
+                length = number(data)
+                for samples in self.gap(length * self.short_time):
+                    yield samples
+
+            elif chunk_id == 0x113:
+                self.set_base_frequency(struct.unpack("<f", data[:4])[0])
+
+            elif chunk_id == 0x114:
+                # Security cycles: ones are short cycles and zeros are long
+                # cycles, with the most significant bit first.
+                count = number(data[:3])
+                values = np.fromstring(data[5:], dtype = np.uint8)
+                bits = np.unpackbits(values)[:count]
+                yield self.cycles(2 - bits.astype(np.int64))
+
+            elif chunk_id == 0x116:
+                for samples in self.gap(struct.unpack("<f", data[:4])[0]):
+                    yield samples
+
+            elif chunk_id == 0x117:
+                if number(data) > 0:
+                    self.baud = number(data)
+
+
+def convert(samples, sample_size):
+
+    """Returns a string containing the samples given, with values between -1
+    and 1, converted to unsigned 8-bit or signed 16-bit little endian
+    values."""
+
+    if sample_size == 8:
+        return np.rint(samples * 127 + 128).astype(np.uint8).tostring()
+    else:
+        return np.rint(samples * 32767).astype("<i2").tostring()
+
+
+if __name__ == "__main__":
+
+    program_name, args = sys.argv[0], sys.argv[1:]
+
+    r, sample_rate = find_option(args, "--rate", 1)
+    s, sample_size = find_option(args, "--size", 1)
+    raw = find_option(args, "--raw", 0)
+
+    if len(args) != 2:
+        sys.stderr.write("Usage: %s [--rate <sample rate in Hz>] [--size <sample size in bits>] [--raw] <UEF file> <audio file>\n" % program_name)
+        sys.exit(1)
+
+    uef_file = args[0]
+    audio_file = args[1]
+
+    try:
+        if r:
+            sample_rate = int(sample_rate)
+        else:
+            sample_rate = 44100
+    except ValueError:
+        sys.stderr.write("Invalid sample rate: %s\n" % sample_rate)
+        sys.exit(1)
+
+    try:
+        if s:
+            sample_size = int(sample_size)
+        else:
+            sample_size = 16
+        if sample_size not in (8, 16):
+            raise ValueError
+    except ValueError:
+        sys.stderr.write("Invalid sample size: %s\n" % sample_size)
+        sys.exit(1)
+
+    try:
+        u = UEFfile.UEFfile(uef_file)
+    except UEFfile.UEFfile_error, exc:
+        sys.stderr.write(str(exc) + "\n")
+        sys.exit(1)
+
+    if audio_file == "-":
+        if not raw:
+            sys.stderr.write("Only raw audio can be written to stdout.\n")
+            sys.exit(1)
+        audio_f = sys.stdout
+    elif raw:
+        audio_f = open(audio_file, "wb")
+    else:
+        audio_f = wave.open(audio_file, "wb")
+        audio_f.setnchannels(1)
+        audio_f.setsampwidth(sample_size / 8)
+        audio_f.setframerate(sample_rate)
+
+    renderer = Renderer(sample_rate)
+
+    for samples in renderer.render(u.chunks):
+        if raw:
+            audio_f.write(convert(samples, sample_size))
+        else:
+            audio_f.writeframesraw(convert(samples, sample_size))
+
+    audio_f.close()
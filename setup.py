@@ -1,9 +1,44 @@
 #! /usr/bin/env python
 
+from distutils.ccompiler import new_compiler
+from distutils.cmd import Command
 from distutils.core import setup
+from distutils.sysconfig import customize_compiler
 
 from UEFfile import version
 
+class build_kernel(Command):
+
+    """Builds the filter kernel in rcfilter.c as a shared library next to
+    audioUEF.py, which loads it with ctypes. Without it, audioUEF uses Numba
+    if it is installed, or else filters with NumPy."""
+
+    description = "build the compiled filter kernel used by audioUEF"
+    user_options = []
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+
+        compiler = new_compiler()
+        customize_compiler(compiler)
+
+        # Keep the arithmetic the same as the Python version by preventing
+        # multiplications and additions from being fused.
+        args = []
+        if compiler.compiler_type == "unix":
+            args = ["-O2", "-ffp-contract=off"]
+
+        build_temp = self.get_finalized_command("build").build_temp
+        objects = compiler.compile(["rcfilter.c"], output_dir = build_temp,
+                                   extra_postargs = args)
+        compiler.link_shared_object(objects,
+                                    "rcfilter" + compiler.shared_lib_extension)
+
 setup(
     name         = "UEFfile",
     description  = "UEF file handling support for Python.",
@@ -11,5 +46,7 @@ setup(
     author_email = "david@boddie.org.uk",
     url          = "http://www.boddie.org.uk/david/Projects/",
     version      = version,
-    py_modules      = ["UEFfile"]
+    py_modules      = ["UEFfile", "audioUEF"],
+    scripts      = ["indexUEF.py", "renderUEF.py"],
+    cmdclass     = {"build_kernel": build_kernel}
     )
@@ -0,0 +1,221 @@
+"""
+test_decode.py - Round-trip tests for renderUEF.py and the audio decoders.
+
+Files are encoded with the UEFfile module, rendered as audio with renderUEF
+and decoded again with recordUEF and each of the detectors in fftUEF. Every
+block must be recovered at each of the sample rates tested.
+"""
+
+import os, random, shutil, struct, sys, tempfile, unittest, wave
+
+if sys.version_info[0] >= 3:
+    raise unittest.SkipTest("The audio tools need Python 2.")
+
+try:
+    import numpy
+except ImportError:
+    raise unittest.SkipTest("The audio tools need NumPy.")
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top)
+
+import UEFfile, audioUEF, fftUEF, recordUEF, renderUEF
+
+
+class DecodingTest(unittest.TestCase):
+
+    sample_rates = (22050, 44100, 48000)
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+
+        r = random.Random(1)
+        self.uef = UEFfile.UEFfile()
+        self.uef.import_files(0, [
+            ("LOADER", 0x1900, 0x1900, "".join(chr(r.randrange(256))
+                                               for i in range(300))),
+            ("GAME", 0x1100, 0x8023, "".join(chr(r.randrange(256))
+                                             for i in range(700)))],
+            gap = True)
+
+        # The name, number and data of each block, excluding the dummy bytes
+        self.expected = []
+        for chunk in self.uef.chunks:
+            if chunk[0] == 0x100 and chunk[1][:1] == "*":
+                name, load, exe, data, number, last = self.uef.read_block(chunk)
+                self.expected.append((name, number, data))
+
+        # The decoders report their progress on stdout.
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def tearDown(self):
+
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory)
+
+    def render(self, sample_rate):
+
+        path = os.path.join(self.directory, "%i.wav" % sample_rate)
+
+        audio_f = wave.open(path, "wb")
+        audio_f.setnchannels(1)
+        audio_f.setsampwidth(2)
+        audio_f.setframerate(sample_rate)
+
+        for samples in renderUEF.Renderer(sample_rate).render(self.uef.chunks):
+            audio_f.writeframesraw(renderUEF.convert(samples, 16))
+
+        audio_f.close()
+        return path
+
+    def decode(self, path, reader):
+
+        wav = audioUEF.WavFile(path)
+        try:
+            reader.start_at(0.0)
+            return [(block.name, block.number, block.block)
+                    for block in reader.read_block(wav)]
+        finally:
+            wav.close()
+
+    def test_record(self):
+
+        for sample_rate in self.sample_rates:
+            reader = recordUEF.Reader("<h", 2, sample_rate, 1.0, 1200.0,
+                                      1200.0, 1/3200.0, 1/7000.0, 6200,
+                                      False, False, True, False)
+            blocks = self.decode(self.render(sample_rate), reader)
+            self.assertEqual(blocks, self.expected, sample_rate)
+
+    def test_goertzel(self):
+
+        for sample_rate in self.sample_rates:
+            reader = fftUEF.Reader("<h", 2, float(sample_rate), "goertzel")
+            blocks = self.decode(self.render(sample_rate), reader)
+            self.assertEqual(blocks, self.expected, sample_rate)
+
+    def test_fft(self):
+
+        for sample_rate in self.sample_rates:
+            reader = fftUEF.Reader("<h", 2, float(sample_rate), "fft")
+            blocks = self.decode(self.render(sample_rate), reader)
+            self.assertEqual(blocks, self.expected, sample_rate)
+
+    def test_stft(self):
+
+        for sample_rate in self.sample_rates:
+            reader = fftUEF.Reader("<h", 2, float(sample_rate), "stft")
+            blocks = self.decode(self.render(sample_rate), reader)
+            self.assertEqual(blocks, self.expected, sample_rate)
+
+
+class SplittingTest(unittest.TestCase):
+
+    sample_rate = 22050
+    reader_args = (1.0, 1200.0, 1200.0, 1/3200.0, 1/7000.0, 6200,
+                   False, False, True, False)
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "ff.wav")
+
+        # Long runs of &FF bytes sound like carrier tone.
+        uef = UEFfile.UEFfile()
+        uef.import_files(0, [("FF", 0x1900, 0x1900, "\xff" * 600)],
+                         gap = True)
+
+        audio_f = wave.open(self.path, "wb")
+        audio_f.setnchannels(1)
+        audio_f.setsampwidth(2)
+        audio_f.setframerate(self.sample_rate)
+
+        renderer = renderUEF.Renderer(self.sample_rate)
+        for samples in renderer.render(uef.chunks):
+            audio_f.writeframesraw(renderUEF.convert(samples, 16))
+
+        audio_f.close()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory)
+
+    def test_split_times(self):
+
+        wav = audioUEF.WavFile(self.path)
+        try:
+            split_times = recordUEF.find_split_times(wav, "<h", 2,
+                                                     self.sample_rate)
+        finally:
+            wav.close()
+
+        wav = audioUEF.WavFile(self.path)
+        try:
+            reader = recordUEF.Reader("<h", 2, self.sample_rate,
+                                      *self.reader_args)
+            reader.start_at(0.0)
+            blocks = list(reader.read_block(wav))
+        finally:
+            wav.close()
+
+        # The audio can only be divided before the first block.
+        self.assertEqual(len(blocks), 3)
+        self.assertTrue(split_times)
+        for t in split_times:
+            self.assertTrue(t < blocks[0].T, (t, blocks[0].T))
+
+    def test_cut_off_block(self):
+
+        # Stop part of the way through the second block.
+        task = (self.path, None, 0, "<h", 2, self.sample_rate,
+                self.reader_args, 0.0, 5.0, False)
+        blocks, error, failures = recordUEF.decode_piece(task)
+        self.assertEqual(len(blocks), 1)
+        self.assertTrue(error and error.startswith("Block cut off"), error)
+
+        # In resilient mode, the block is recorded as a failure instead.
+        blocks, error, failures = recordUEF.decode_piece(task[:-1] + (True,))
+        self.assertEqual(len(blocks), 1)
+        self.assertEqual(error, None)
+        self.assertEqual(len(failures), 1)
+
+
+class RenderingTest(unittest.TestCase):
+
+    def test_rendered_length(self):
+
+        # Data at baud rates above, below and between whole fractions of
+        # 1200 baud, with a change of base frequency part of the way through
+        r = random.Random(2)
+        data = "".join(chr(r.randrange(256)) for i in range(50))
+        uef = UEFfile.UEFfile()
+        uef.chunks = [(0x110, uef.number(2, 600)),
+                      (0x100, data),
+                      (0x117, uef.number(2, 2400)),
+                      (0x100, data),
+                      (0x112, uef.number(2, 100)),
+                      (0x117, uef.number(2, 1000)),
+                      (0x104, "\x07E\x02" + data),
+                      (0x113, struct.pack("<f", 1000.0)),
+                      (0x117, uef.number(2, 300)),
+                      (0x111, uef.number(2, 50) + uef.number(2, 50)),
+                      (0x102, "\x03" + data),
+                      (0x114, uef.number(3, 20) + "PP\xa5\x5a\xf0"),
+                      (0x116, struct.pack("<f", 0.25)),
+                      (0x100, data)]
+
+        duration = uef.chunk_times()[-1]
+
+        for sample_rate in (22050, 44100, 48000):
+            samples = 0
+            for block in renderUEF.Renderer(sample_rate).render(uef.chunks):
+                samples += len(block)
+            self.assertTrue(abs(samples - duration * sample_rate) <= 1,
+                            (sample_rate, samples, duration * sample_rate))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,234 @@
+"""
+test_uef.py - Round-trip tests for the UEFfile module.
+
+Run the tests from the top level directory with
+
+  python -m unittest discover tests
+
+With Python 3, the module in the py3 directory is tested instead.
+"""
+
+import gzip, io, os, random, shutil, struct, sys, tempfile, unittest
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if sys.version_info[0] >= 3:
+    sys.path.insert(0, os.path.join(top, "py3"))
+else:
+    sys.path.insert(0, top)
+
+import UEFfile
+
+
+def random_bytes(length, seed):
+
+    r = random.Random(seed)
+    return bytes(bytearray(r.randrange(256) for i in range(length)))
+
+
+def legacy_crc(s):
+
+    """Returns the CRC of the bytes given, calculated a bit at a time as it
+    was before the table was introduced."""
+
+    u = UEFfile.UEFfile()
+    high = 0
+    low = 0
+
+    for i in bytearray(s):
+
+        high = high ^ i
+
+        for j in range(0, 8):
+
+            a, carry = u.rol(high, 0)
+
+            if carry == 1:
+                high = high ^ 8
+                low = low ^ 16
+
+            low, carry = u.rol(low, carry)
+            high, carry = u.rol(high, carry)
+
+    return high | (low << 8)
+
+
+def legacy_chunks(name, load, exe, data):
+
+    """Returns the chunks for a file, encoded a field at a time as they were
+    before the precompiled structures were introduced."""
+
+    u = UEFfile.UEFfile()
+    chunks = []
+    block_number = 0
+    gap = 1
+
+    while True:
+
+        last = (len(data) <= 256)
+        block = data[:256]
+
+        out = b"*" + name[:10] + b"\000"
+        out = out + u.number(4, load) + u.number(4, exe)
+        out = out + u.number(2, block_number) + u.number(2, len(block))
+        if last:
+            out = out + u.number(1, 128)
+        else:
+            out = out + u.number(1, 0)
+        out = out + u.number(4, 0)
+        out = out + u.number(2, legacy_crc(out[1:]))
+        out = out + block + u.number(2, legacy_crc(block))
+
+        data = data[256:]
+
+        if gap == 1:
+            chunks.append((0x110, u.number(2, 0x05dc)))
+            gap = 0
+        else:
+            chunks.append((0x110, u.number(2, 0x0258)))
+
+        chunks.append((0x100, out))
+
+        if last:
+            break
+
+        block_number = block_number + 1
+
+    return chunks
+
+
+class EncodingTest(unittest.TestCase):
+
+    sizes = (0, 1, 255, 256, 257, 1000, 4096)
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory)
+
+    def files(self):
+
+        return [(("FILE%i" % i).encode("ascii"), 0x1900 + i, 0x8023,
+                 random_bytes(size, size)) for i, size in enumerate(self.sizes)]
+
+    def test_crc(self):
+
+        u = UEFfile.UEFfile()
+        for size in (0, 1, 2, 17, 256):
+            data = random_bytes(size, size + 1)
+            self.assertEqual(u.crc(data), legacy_crc(data))
+
+    def test_create_chunks(self):
+
+        u = UEFfile.UEFfile()
+        for name, load, exe, data in self.files():
+            self.assertEqual(u.create_chunks(name, load, exe, data),
+                             legacy_chunks(name, load, exe, data))
+
+    def test_stream_chunks(self):
+
+        u = UEFfile.UEFfile()
+        gap_chunks = [(0x112, b"\xdc\x05"), (0x110, b"\xdc\x05"),
+                      (0x100, b"\xdc")]
+        for name, load, exe, data in self.files():
+            for buffer_size in (1, 100, 256, 65536):
+                chunks = list(u.stream_chunks(name, load, exe, io.BytesIO(data),
+                                              True, buffer_size))
+                self.assertEqual(chunks, gap_chunks +
+                                 u.create_chunks(name, load, exe, data))
+
+    def test_write_and_read(self):
+
+        files = self.files()
+        path = os.path.join(self.directory, "test.uef")
+
+        u = UEFfile.UEFfile()
+        u.import_files(0, files, gap = True)
+        u.write(path)
+
+        v = UEFfile.UEFfile(path)
+        self.assertEqual(v.chunks, u.chunks)
+        self.assertEqual([(f["name"], f["load"], f["exec"], f["data"])
+                          for f in v.contents], files)
+
+    def test_parallel_import(self):
+
+        files = self.files()
+
+        u = UEFfile.UEFfile()
+        u.import_files(0, files, gap = True)
+
+        v = UEFfile.UEFfile()
+        v.import_files(0, files, gap = True, processes = 2)
+
+        self.assertEqual(v.chunks, u.chunks)
+
+    def test_timing_profiles(self):
+
+        files = self.files()
+
+        u = UEFfile.UEFfile()
+        u.timing = UEFfile.get_timing_profile("turbo")
+        u.import_files(0, files, gap = True)
+
+        v = UEFfile.UEFfile()
+        v.timing = UEFfile.get_timing_profile("c0,30,10,c0")
+        v.timing.dummy_byte = False
+        v.import_files(0, files, gap = True, processes = 2)
+
+        self.assertEqual(v.chunks, u.chunks)
+        self.assertEqual(u.chunks[:3], [(0x112, b"\x10\x00"),
+                                        (0x110, b"\xc0\x00"),
+                                        (0x110, b"\xc0\x00")])
+        self.assertEqual([(f["name"], f["data"]) for f in u.contents],
+                         [(f[0], f[3]) for f in files])
+
+        self.assertRaises(UEFfile.UEFfile_error, UEFfile.get_timing_profile,
+                          "c0,30,10")
+
+    def test_writer(self):
+
+        files = self.files()
+        path = os.path.join(self.directory, "test.uef")
+
+        u = UEFfile.UEFfile()
+        u.import_files(0, files[:1])
+
+        writer = u.writer(path)
+        for name, load, exe, data in files[1:]:
+            writer.write_chunks(u.create_chunks(name, load, exe, data))
+            writer.flush()
+
+        # The file can be read before the writer is closed.
+        v = UEFfile.UEFfile(path)
+        self.assertEqual([f["data"] for f in v.contents],
+                         [f[3] for f in files])
+
+        writer.close()
+
+    def test_chunk_times(self):
+
+        u = UEFfile.UEFfile()
+        u.chunks = [(0x110, struct.pack("<H", 1200)),
+                    (0x100, b"\x00" * 120),
+                    (0x102, b"\x08" + b"\x00" * 76),
+                    (0x117, struct.pack("<H", 300)),
+                    (0x100, b"\x00" * 30),
+                    (0x116, struct.pack("<f", 0.5))]
+
+        times = u.chunk_times()
+        expected = [0.0, 0.5, 1.5, 2.0, 2.0, 3.0, 3.5]
+
+        self.assertEqual(len(times), len(expected))
+        for t, e in zip(times, expected):
+            self.assertAlmostEqual(t, e)
+
+        u.chunks = [(0x110, b"\x00")]
+        self.assertRaises(UEFfile.UEFfile_error, u.chunk_times)
+
+
+if __name__ == "__main__":
+    unittest.main()